@@ -0,0 +1,249 @@
+#combat balance simulator: fights of the player against groups of monsters, with the rules of Fighter.attack,
+#Fighter.take_damage, Mage.cast_lightning and Mage.regenerate, on a line where only the distance of each
+#monster to the player matters. the stats come from rogue.PLAYER_STATS and rogue.MONSTER_STATS, and any of
+#them can be swept over a list of values:
+#	python balance.py --monsters orc,orc --monsters troll --lightning never --lightning always
+#	python balance.py --monsters troll,troll --player-power 3,4,5 --player-hp 20,30,40
+#all the fights of a configuration are played together, a round at a time, as a distribution of fight
+#states: fights in the same state are merged, and a lightning bolt splits a state in one per possible
+#damage. that gives the exact results that millions of sampled fights tend to, in a fraction of a second.
+#--sample plays that many random fights one by one instead, with the same rules, to cross-check them
+import argparse
+import itertools
+import json
+import random
+import time
+
+import rogue
+
+#fights still going on after this many rounds are counted as draws
+MAX_ROUNDS = 500
+
+DEFAULT_MONSTERS = ['orc', 'troll', 'orc,orc,orc', 'troll,troll', 'orc,orc,troll,troll']
+
+
+class Config:
+	#one configuration of a fight: the kinds of the monsters, how far they start from the player, how many
+	#of them can stand next to the player at once (8 in the open, 1 in a corridor), whether the player casts
+	#lightning bolts, and the stats of everyone
+	def __init__(self, monsters, distance, adjacent, lightning, player_stats, monster_stats):
+		self.monsters = monsters
+		self.distance = distance
+		self.adjacent = adjacent
+		self.lightning = lightning
+		(self.hp, self.defense, self.power, self.mp) = player_stats
+		self.monster_stats = [monster_stats[kind] for kind in monsters]
+
+	def start(self):
+		#the state of a fight: hp and mp of the player, turns since the last mp regeneration, and the hp and
+		#distance of every monster (0 hp once dead)
+		return (self.hp, self.mp, 0, tuple((stats[0], self.distance) for stats in self.monster_stats))
+
+	def describe(self):
+		return {'monsters': ','.join(self.monsters), 'distance': self.distance, 'adjacent': self.adjacent,
+			'lightning': self.lightning, 'hp': self.hp, 'defense': self.defense, 'power': self.power, 'mp': self.mp}
+
+
+def play_round(config, state):
+	#play one round of a fight: the player acts, then every monster in turn. returns the possible next
+	#states with their probabilities; there are several only when the player casts a lightning bolt
+	(hp, mp, turns, monsters) = state
+
+	#the player zaps the closest monster in range, like headless_target, when it has the mana for it
+	target = None
+	if config.lightning and mp > 1:
+		for (i, (monster_hp, distance)) in enumerate(monsters):
+			if monster_hp > 0 and 1 < distance <= rogue.LIGHTNING_RANGE:
+				if target is None or distance < monsters[target][1]:
+					target = i
+	if target is not None:
+		(monster_hp, distance) = monsters[target]
+		outcomes = []
+		for roll in range(1, rogue.LIGHTNING_MAX_DAMAGE + 1):
+			hit = list(monsters)
+			hit[target] = (max(0, monster_hp - 2 * roll), distance)
+			outcomes.append((monsters_act(config, hp, mp - 2, turns, hit), 1.0 / rogue.LIGHTNING_MAX_DAMAGE))
+		return outcomes
+
+	#otherwise the player spends a turn, regenerating mana, and attacks the weakest monster next to it
+	turns = (turns + 1) % rogue.MP_REGENERATION_INTERVAL
+	if turns == 0:
+		mp = min(mp + 1, config.mp)
+	target = None
+	for (i, (monster_hp, distance)) in enumerate(monsters):
+		if monster_hp > 0 and distance <= 1:
+			if target is None or monster_hp < monsters[target][0]:
+				target = i
+	monsters = list(monsters)
+	if target is not None:
+		damage = config.power - config.monster_stats[target][1]
+		if damage > 0:
+			(monster_hp, distance) = monsters[target]
+			monsters[target] = (max(0, monster_hp - damage), distance)
+	return [(monsters_act(config, hp, mp, turns, monsters), 1.0)]
+
+def monsters_act(config, hp, mp, turns, monsters):
+	#every living monster walks towards the player, if there is room next to it, or attacks it
+	adjacent = 0
+	for (monster_hp, distance) in monsters:
+		if monster_hp > 0 and distance <= 1:
+			adjacent += 1
+	for (i, (monster_hp, distance)) in enumerate(monsters):
+		if monster_hp <= 0 or hp <= 0:
+			continue
+		if distance > 1:
+			if distance > 2 or adjacent < config.adjacent:
+				monsters[i] = (monster_hp, distance - 1)
+				if distance == 2:
+					adjacent += 1
+		else:
+			damage = config.monster_stats[i][2] - config.defense
+			if damage > 0:
+				hp -= damage
+	return (max(0, hp), mp, turns, tuple(monsters))
+
+def outcome(state):
+	#'lost' once the player is dead, 'won' once every monster is, None while the fight goes on
+	(hp, mp, turns, monsters) = state
+	if hp <= 0:
+		return 'lost'
+	for (monster_hp, distance) in monsters:
+		if monster_hp > 0:
+			return None
+	return 'won'
+
+
+def simulate(config, max_rounds=MAX_ROUNDS):
+	#play all the fights of a configuration together. returns the probability of every ending: the outcome,
+	#the round it happened at, and the hp and mp the player was left with
+	results = {}
+	states = {config.start(): 1.0}
+	for turn in range(1, max_rounds + 1):
+		next_states = {}
+		for (state, probability) in states.items():
+			for (next_state, branch) in play_round(config, state):
+				probability_next = probability * branch
+				end = outcome(next_state)
+				if end:
+					key = (end, turn, next_state[0], next_state[1])
+					results[key] = results.get(key, 0.0) + probability_next
+				else:
+					next_states[next_state] = next_states.get(next_state, 0.0) + probability_next
+		states = next_states
+		if not states:
+			break
+	for (state, probability) in states.items():
+		key = ('draw', max_rounds, state[0], state[1])
+		results[key] = results.get(key, 0.0) + probability
+	return results
+
+def sample(config, fights, rng, max_rounds=MAX_ROUNDS):
+	#play random fights one by one instead, and return the share of every ending like simulate
+	results = {}
+	for fight in range(fights):
+		state = config.start()
+		end = None
+		for turn in range(1, max_rounds + 1):
+			roll = rng.random()
+			for (state, branch) in play_round(config, state):
+				roll -= branch
+				if roll < 0:
+					break
+			end = outcome(state)
+			if end:
+				break
+		key = (end or 'draw', turn, state[0], state[1])
+		results[key] = results.get(key, 0.0) + 1.0 / fights
+	return results
+
+
+def percentile(values, fraction):
+	#the smallest value with at least this fraction of the weight at or below it, from (value, weight) pairs
+	total = sum(weight for (value, weight) in values)
+	seen = 0.0
+	for (value, weight) in sorted(values):
+		seen += weight
+		if seen >= fraction * total - 1e-9:
+			return value
+	return None
+
+def summarize(results):
+	#win, loss and draw rates, and for the fights won: rounds to kill every monster, and the hp and mp left
+	summary = {}
+	for end in ('won', 'lost', 'draw'):
+		summary[end] = round(sum(p for (key, p) in results.items() if key[0] == end), 4)
+	won = [(key, p) for (key, p) in results.items() if key[0] == 'won']
+	total = sum(p for (key, p) in won)
+	for (name, index) in (('rounds', 1), ('hp_left', 2), ('mp_left', 3)):
+		values = [(key[index], p) for (key, p) in won]
+		if total > 0:
+			summary[name] = {'mean': round(sum(v * p for (v, p) in values) / total, 2),
+				'p10': percentile(values, 0.1), 'p50': percentile(values, 0.5), 'p90': percentile(values, 0.9)}
+		else:
+			summary[name] = None
+	return summary
+
+def format_summary(config, summary):
+	line = '%-20s d%-2d a%d %-7s hp %3d def %d pow %d mp %3d | won %5.1f%% lost %5.1f%% draw %5.1f%%' % (
+		','.join(config.monsters), config.distance, config.adjacent, config.lightning and 'zap' or 'melee',
+		config.hp, config.defense, config.power, config.mp,
+		100 * summary['won'], 100 * summary['lost'], 100 * summary['draw'])
+	if summary['rounds']:
+		line += ' | rounds %d/%d/%d hp %d/%d/%d mp %.1f' % (summary['rounds']['p10'], summary['rounds']['p50'],
+			summary['rounds']['p90'], summary['hp_left']['p10'], summary['hp_left']['p50'], summary['hp_left']['p90'],
+			summary['mp_left']['mean'])
+	return line
+
+
+def int_list(text):
+	return [int(value) for value in text.split(',')]
+
+def main():
+	parser = argparse.ArgumentParser(description='Simulate fights to balance the stats of the player and monsters')
+	parser.add_argument('--monsters', action='append', help='comma separated kinds of the monsters of a fight ' +
+		'(can be repeated; default: ' + ' '.join(DEFAULT_MONSTERS) + ')')
+	parser.add_argument('--distance', type=int_list, default=[rogue.LIGHTNING_RANGE], help='distances the monsters start at')
+	parser.add_argument('--adjacent', type=int_list, default=[8], help='how many monsters can attack the player at once')
+	parser.add_argument('--lightning', action='append', choices=['never', 'always'],
+		help='whether the player zaps monsters in range (can be repeated; default: both)')
+	(hp, defense, power, mp) = rogue.PLAYER_STATS
+	parser.add_argument('--player-hp', type=int_list, default=[hp])
+	parser.add_argument('--player-defense', type=int_list, default=[defense])
+	parser.add_argument('--player-power', type=int_list, default=[power])
+	parser.add_argument('--player-mp', type=int_list, default=[mp])
+	parser.add_argument('--rounds', type=int, default=MAX_ROUNDS, help='rounds after which a fight is a draw')
+	parser.add_argument('--sample', type=int, help='play this many random fights per configuration instead')
+	parser.add_argument('--seed', type=int, default=0, help='seed of the random fights')
+	parser.add_argument('--json', action='store_true', help='print the results as JSON')
+	args = parser.parse_args()
+
+	for monsters in args.monsters or []:
+		for kind in monsters.split(','):
+			if kind not in rogue.MONSTER_STATS:
+				parser.error('unknown monster: ' + kind)
+
+	configs = []
+	for (monsters, distance, adjacent, lightning, hp, defense, power, mp) in itertools.product(
+			args.monsters or DEFAULT_MONSTERS, args.distance, args.adjacent, args.lightning or ['never', 'always'],
+			args.player_hp, args.player_defense, args.player_power, args.player_mp):
+		configs.append(Config(monsters.split(','), distance, adjacent, lightning == 'always',
+			(hp, defense, power, mp), rogue.MONSTER_STATS))
+
+	rng = random.Random(args.seed)
+	start = time.time()
+	results = []
+	for config in configs:
+		if args.sample:
+			summary = summarize(sample(config, args.sample, rng, args.rounds))
+		else:
+			summary = summarize(simulate(config, args.rounds))
+		results.append((config, summary))
+		if not args.json:
+			print(format_summary(config, summary))
+	if args.json:
+		print(json.dumps([dict(config.describe(), **summary) for (config, summary) in results], indent=1, sort_keys=True))
+	else:
+		print('%d configurations in %.2fs (rounds, hp: p10/p50/p90 of the fights won)' % (len(configs), time.time() - start))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,251 @@
+#benchmarks for the hot paths of the game, on fixed seeds. the results are printed as JSON, in seconds
+#(the best of several runs), and can be compared with the results of an earlier commit:
+#	python bench.py > before.json
+#	python bench.py --compare before.json
+import libtcodpy as libtcod
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import rogue
+
+SEED = 1234
+
+#map generation: width, height and number of rooms to try
+MAP_CASES = [(80, 50, 30), (120, 75, 50), (300, 200, 400), (1000, 1000, 4000)]
+FREE_SPACE_MAP_CASES = [(1000, 1000, 4000), (1000, 1000, 10000)]
+
+#AI phase: number of monsters, and the map (width, height, rooms) they are spread over
+AI_CASES = [(10, 120, 75, 50), (100, 120, 75, 50), (1000, 300, 200, 400), (10000, 1000, 1000, 4000)]
+
+
+def best_time(function, repeat):
+	#run a function several times and return the fastest run, in seconds
+	best = None
+	for i in range(repeat):
+		start = time.time()
+		function()
+		elapsed = time.time() - start
+		if best is None or elapsed < best:
+			best = elapsed
+	return best
+
+def set_map_size(width, height, max_rooms):
+	rogue.MAP_WIDTH = width
+	rogue.MAP_HEIGHT = height
+	rogue.MAX_ROOMS = max_rooms
+
+def start_game(width, height, max_rooms, monsters):
+	#start a game on a map of the given size, with the given number of monsters on free tiles
+	set_map_size(width, height, max_rooms)
+	room_monsters = rogue.MAX_ROOM_MONSTERS
+	rogue.MAX_ROOM_MONSTERS = 0
+	try:
+		rogue.new_game(SEED)
+	finally:
+		rogue.MAX_ROOM_MONSTERS = room_monsters
+
+	rng = random.Random(SEED)
+	free = [(x, y) for x in range(width) for y in range(height) if not rogue.is_blocked(x, y)]
+	for (x, y) in rng.sample(free, min(monsters, len(free))):
+		rogue.add_object(rogue.make_monster(rng.choice(['orc', 'troll']), x, y))
+
+	rogue.con = libtcod.console_new(rogue.CAMERA_WIDTH, rogue.CAMERA_HEIGHT)
+	rogue.update_fov()
+
+def bench_make_map(results, repeat):
+	for (width, height, max_rooms) in MAP_CASES:
+		set_map_size(width, height, max_rooms)
+		results['make_map %dx%d %d rooms' % (width, height, max_rooms)] = best_time(lambda: rogue.make_map(SEED), repeat)
+	rogue.ROOM_SAMPLE_FREE_SPACE = True
+	try:
+		for (width, height, max_rooms) in FREE_SPACE_MAP_CASES:
+			set_map_size(width, height, max_rooms)
+			results['make_map %dx%d %d rooms in free space' % (width, height, max_rooms)] = best_time(lambda: rogue.make_map(SEED), repeat)
+	finally:
+		rogue.ROOM_SAMPLE_FREE_SPACE = False
+
+def slowest_monster_turn():
+	#play the monsters' turn and return the longest turn of a single monster, which play_monster_turns cannot
+	#spread over frames
+	slowest = 0
+	turns = rogue.monster_turns()
+	while True:
+		start = time.time()
+		if next(turns, True):
+			return slowest
+		slowest = max(slowest, time.time() - start)
+
+def bench_ai(results, repeat):
+	for (monsters, width, height, max_rooms) in AI_CASES:
+		start_game(width, height, max_rooms, monsters)
+		results['ai turn %d monsters' % monsters] = best_time(rogue.monsters_take_turns, repeat)
+		#the worst of the runs, not the best: the first turn on a level is the slowest one
+		results['ai slowest monster turn %d monsters' % monsters] = max(slowest_monster_turn() for i in range(repeat))
+
+def bench_fov_and_render(results, repeat):
+	start_game(120, 75, 50, 0)
+
+	def fov():
+		#a position the FOV was not computed for yet
+		rogue.fov_cache.clear()
+		rogue.fov_origin = None
+		rogue.fov_recompute = True
+		rogue.update_fov()
+
+	def cached_fov():
+		#stepping back to a position the FOV was already computed for
+		rogue.player.move(1, 0)
+		rogue.fov_recompute = True
+		rogue.update_fov()
+		rogue.player.move(-1, 0)
+		rogue.fov_recompute = True
+		rogue.update_fov()
+
+	def full_tile_pass():
+		#what render_all used to do every frame: set the background of every tile
+		rogue.tile_cache[:] = bytearray([rogue.TILE_NOT_DRAWN]) * len(rogue.tile_cache)
+		rogue.render_tiles((0, 0, rogue.MAP_WIDTH, rogue.MAP_HEIGHT))
+
+	def moved_tile_pass():
+		#the tile pass of render_all after the player moved one step
+		rogue.player.move(1, 0)
+		rogue.fov_recompute = True
+		rogue.render_all()
+		rogue.player.move(-1, 0)
+		rogue.fov_recompute = True
+		rogue.render_all()
+
+	rogue.panel = libtcod.console_new(rogue.SCREEN_WIDTH, rogue.PANEL_HEIGHT)
+	rogue.mouse = libtcod.Mouse()
+	rogue.render_all()
+	results['map_compute_fov'] = best_time(fov, repeat)
+	rogue.update_fov()
+	results['fov cache hit'] = best_time(cached_fov, repeat) / 2
+	results['render tiles full pass'] = best_time(full_tile_pass, repeat)
+	results['render_all after a step'] = best_time(moved_tile_pass, repeat) / 2
+	results['render_all idle frame'] = best_time(rogue.render_all, repeat)
+
+def bench_astar(results, repeat):
+	start_game(120, 75, 50, 0)
+
+	#a monster in the free tile furthest from the player that A* still walks to (paths up to 24 steps)
+	player = rogue.player
+	candidates = [(x, y) for x in range(rogue.MAP_WIDTH) for y in range(rogue.MAP_HEIGHT)
+		if not rogue.is_blocked(x, y) and max(abs(x - player.x), abs(y - player.y)) <= 16]
+	(x, y) = max(candidates, key=lambda pos: ((pos[0] - player.x) ** 2 + (pos[1] - player.y) ** 2, pos))
+	monster = rogue.make_monster('orc', x, y)
+	rogue.add_object(monster)
+
+	def astar():
+		monster.move_astar(player)
+		monster.place(x, y)
+
+	results['move_astar'] = best_time(astar, repeat)
+
+	#a monster in the room furthest from the player on a big map, too far for A*: it goes along the room graph
+	start_game(1000, 1000, 4000, 0)
+	player = rogue.player
+	graph = rogue.room_graph
+	(x, y) = max(graph.centers, key=lambda pos: ((pos[0] - player.x) ** 2 + (pos[1] - player.y) ** 2, pos))
+	monster = rogue.make_monster('orc', x, y)
+	rogue.add_object(monster)
+
+	def far():
+		monster.move_far(player.x, player.y)
+		monster.place(x, y)
+
+	def far_new_target():
+		graph.fields.clear()
+		far()
+
+	def new_graph():
+		rogue.RoomGraph(rogue.map.width, rogue.map.height, graph.rooms, graph.links)
+
+	results['move_far 1000x1000'] = best_time(far, repeat)
+	results['move_far 1000x1000 new target'] = best_time(far_new_target, repeat)
+	results['room graph 1000x1000 (level load)'] = best_time(new_graph, repeat)
+
+def bench_world(results, repeat):
+	#moving the window of a world by one chunk and back, with the chunks already generated (or not)
+	rogue.new_game(SEED, world=True)
+	(x, y) = (rogue.player.x - rogue.CHUNK_SIZE, rogue.player.y - rogue.CHUNK_SIZE)  #world position
+
+	def shift():
+		rogue.load_window(0, -1, x, y)
+		rogue.load_window(-1, -1, x, y)
+
+	def new_chunks():
+		rogue.chunk_cache.clear()
+		shift()
+
+	results['world window shift'] = best_time(shift, repeat) / 2
+	results['world window shift with new chunks'] = best_time(new_chunks, repeat) / 2
+
+def bench_save(results, repeat):
+	#a snapshot of the biggest AI case, written and read back
+	start_game(1000, 1000, 4000, 10000)
+	path = os.path.join(rogue.LEVEL_CACHE_DIR, 'bench.sav')
+	results['save_game 1000x1000 10000 monsters'] = best_time(lambda: rogue.save_game(path), repeat)
+	results['load_game 1000x1000 10000 monsters'] = best_time(lambda: rogue.load_game(path), repeat)
+
+BENCHMARKS = [
+	('make_map', bench_make_map),
+	('ai', bench_ai),
+	('fov', bench_fov_and_render),
+	('astar', bench_astar),
+	('world', bench_world),
+	('save', bench_save),
+]
+
+def compare(results, old_results, threshold):
+	#print how each result changed, and return the names of the ones that got slower by more than threshold
+	regressions = []
+	for name in sorted(results):
+		if name not in old_results:
+			continue
+		ratio = results[name] / max(old_results[name], 1e-9)
+		flag = ''
+		if ratio > 1 + threshold:
+			flag = '  SLOWER'
+			regressions.append(name)
+		sys.stderr.write('%-40s %10.6f -> %10.6f  x%.2f%s\n' % (name, old_results[name], results[name], ratio, flag))
+	return regressions
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmark the hot paths of the game.')
+	parser.add_argument('--repeat', type=int, default=5, help='runs of each benchmark, the fastest one is kept')
+	parser.add_argument('--only', action='append', choices=[name for (name, function) in BENCHMARKS],
+		help='only run the given benchmarks (can be repeated)')
+	parser.add_argument('--compare', metavar='JSON', help='results of an earlier run to compare with')
+	parser.add_argument('--threshold', type=float, default=0.2,
+		help='slowdown (0.2 is 20%%) above which --compare reports a regression and exits with status 1')
+	args = parser.parse_args()
+
+	#levels made by new_game go to a throwaway cache, so every run generates them the same way
+	rogue.LEVEL_CACHE_DIR = tempfile.mkdtemp()
+	rogue.CHUNK_DIR = rogue.LEVEL_CACHE_DIR
+	rogue.headless = True
+	results = {}
+	try:
+		for (name, function) in BENCHMARKS:
+			if not args.only or name in args.only:
+				function(results, args.repeat)
+	finally:
+		shutil.rmtree(rogue.LEVEL_CACHE_DIR)
+
+	print(json.dumps({'seed': SEED, 'repeat': args.repeat, 'results': results}, indent=2, sort_keys=True))
+
+	if args.compare:
+		with open(args.compare) as f:
+			old_results = json.load(f)['results']
+		if compare(results, old_results, args.threshold):
+			sys.exit(1)
+
+if __name__ == '__main__':
+	main()
@@ -1,11 +1,34 @@
 import libtcodpy as libtcod
+import argparse
+import array
+import collections
+import csv
+import hashlib
+import heapq
+import itertools
+import json
 import math
+import mmap
+import multiprocessing
+import os
+import pickle
+import random
+import select
+import shutil
+import struct
+import sys
 import textwrap
+import time
+import zlib
 
 SCREEN_WIDTH = 120
 SCREEN_HEIGHT = 80
 LIMIT_FPS = 20
 
+#the monsters of a turn play for at most this many seconds per frame in the window and in the terminal, and
+#the ones left continue in the next frames (see play_monster_turns). --ai-budget changes it, 0 plays them all
+AI_FRAME_BUDGET = 0.012
+
 LIGHTNING_RANGE = 5
 LIGHTNING_MAX_DAMAGE = 5
 
@@ -18,44 +41,294 @@ ROOM_MAX_SIZE = 10
 ROOM_MIN_SIZE = 6
 MAX_ROOMS = 50
 
+#place the rooms in free cells of a grid instead of at random spots, so no try is wasted on a room that
+#overlaps another one. much faster on huge maps full of rooms, but the rooms end up lined up on the grid
+ROOM_SAMPLE_FREE_SPACE = False
+
 FOV_ALGO = 0  #default FOV algorithm
 FOV_LIGHT_WALLS = True
 TORCH_RADIUS = 10
 
+#how many player positions the FOV is remembered for
+FOV_CACHE_SIZE = 4096
+
 #sizes and coordinates relevant for the GUI
 BAR_WIDTH = 20
 PANEL_HEIGHT = 7
 PANEL_Y = SCREEN_HEIGHT - PANEL_HEIGHT
 
+#the part of the map shown above the panel. it scrolls to keep the player at least CAMERA_MARGIN tiles
+#away from its edges, but never past the edges of the map
+CAMERA_WIDTH = SCREEN_WIDTH
+CAMERA_HEIGHT = PANEL_Y
+CAMERA_MARGIN = 20
+
 
 MSG_X = BAR_WIDTH + 2
 MSG_WIDTH = SCREEN_WIDTH - BAR_WIDTH - 2
 MSG_HEIGHT = PANEL_HEIGHT - 1
 
+#the message log keeps the last MSG_LOG_SIZE messages (only the last MSG_HEIGHT lines are shown). with
+#--combat-log, every combat event is also written to a file, COMBAT_LOG_BATCH events at a time
+MSG_LOG_SIZE = 50
+COMBAT_LOG_BATCH = 1000
+
 MAX_ROOM_MONSTERS = 3
 
+#generated levels are cached in this directory, keyed by their seed and the generator parameters.
+#change LEVEL_FORMAT whenever make_map changes, so that old cached levels are not used anymore
+LEVEL_CACHE_DIR = 'levels'
+LEVEL_FORMAT = 2
+
+#instead of a level, a game can be played in an endless world made of CHUNK_SIZE x CHUNK_SIZE chunks, each
+#generated from the seed and its position when the player first comes near. the game is played on the
+#WINDOW_CHUNKS x WINDOW_CHUNKS chunks around the player; of the others, the last CHUNK_CACHE_SIZE ones
+#are kept in memory and older ones are written to CHUNK_DIR
+CHUNK_SIZE = 64
+CHUNK_ROOMS = 12
+WINDOW_CHUNKS = 3
+CHUNK_CACHE_SIZE = 64
+CHUNK_DIR = 'chunks'
+CHUNK_FORMAT = 1
+
+#a snapshot of a game (see save_game) starts with this header: magic, format, map width and height, number of
+#entities and of entity fields. change SAVE_FORMAT whenever what is saved changes, so older snapshots are refused
+SAVE_HEADER = '<8sIIIII'
+SAVE_MAGIC = 'ROGUESAV'
+SAVE_FORMAT = 6
+
+#a recording (see start_recording) is a header line, then one line per event and a checkpoint line with
+#the hash of the game state every REPLAY_CHECKPOINT_TURNS turns, and at the end
+REPLAY_FORMAT = 7
+REPLAY_CHECKPOINT_TURNS = 100
+
+#how many worker processes generate levels in the background, see prefetch_levels
+LEVEL_WORKERS = 2
+
 MONSTER_GROUP_RANGE = 50
 
+#how far (in steps, diagonals cost 1.41) the shared distance field towards the player reaches.
+#chasing monsters further away than this fall back to move_far
+CHASE_FIELD_RADIUS = 25
+
+#monsters only look for an A* path this short (see move_astar); further away, they go along the room graph
+#(see RoomGraph). the routes of the graph to the last ROOM_FIELD_CACHE_SIZE rooms they head for are remembered
+ASTAR_MAX_PATH = 25
+ROOM_FIELD_CACHE_SIZE = 16
+
+#the eight steps to the neighbouring tiles, with their cost: straight ones first
+NEIGHBOUR_STEPS = [(0, -1, 1), (0, 1, 1), (-1, 0, 1), (1, 0, 1),
+	(-1, -1, 1.41), (1, -1, 1.41), (-1, 1, 1.41), (1, 1, 1.41)]
+
+#size in tiles of the square buckets used to find neighbouring fighters
+NEIGHBOUR_BUCKET_SIZE = 8
+
+#monsters act on a schedule: one turn of the player lasts TURN_TICKS, and a monster with a speed of
+#NORMAL_SPEED acts once per turn (twice as fast, twice per turn...)
+TURN_TICKS = 100
+NORMAL_SPEED = 100
+MONSTER_SPEEDS = {'orc': NORMAL_SPEED, 'troll': NORMAL_SPEED}
+
+#the stats of the player (hp, defense, power, mp) and of each kind of monster (hp, defense, power)
+PLAYER_STATS = (30, 2, 3, 20)
+MONSTER_STATS = {'orc': (10, 0, 3), 'troll': (16, 1, 4)}
+
+#monsters further than this from the player fall asleep and skip their turns, until the player comes
+#close again or a noise within its radius wakes them up. a monster that heard a noise stays awake for
+#NOISE_ALERT_TICKS, even if the player gets further away
+ACTIVITY_RADIUS = 30
+COMBAT_NOISE_RADIUS = 10
+THUNDER_NOISE_RADIUS = 25
+NOISE_ALERT_TICKS = 10 * TURN_TICKS
+
+#when set, the occupancy indexes and neighbour buckets are checked against the layers after every turn
+DEBUG = False
+
+#profiling of the phases of the main loop, toggled with F3 or --profile. the overlay on the panel shows the
+#average and p99 of each phase over the last PROFILE_WINDOW turns, and every turn is written to PROFILE_TRACE_FILE
+PROFILE_PHASES = ['handle_keys', 'ai', 'astar', 'fov', 'tiles', 'render', 'flush']
+PROFILE_WINDOW = 200
+PROFILE_TRACE_FILE = 'profile.csv'
+
+#the AI states of a BasicMonster, as numbered in the entity arrays
+AI_STATES = ['flocking', 'chasing']
+
 color_dark_wall = libtcod.Color(0, 0, 100)
 color_light_wall = libtcod.Color(130, 110, 50)
 color_dark_ground = libtcod.Color(50, 50, 150)
 color_light_ground = libtcod.Color(200, 180, 50)
 
-#create the list of game messages and their colors, starts empty
-game_msgs = []
+#the background color of a tile, indexed by its render state: 2 * visible + wall
+tile_colors = [color_dark_ground, color_dark_wall, color_light_ground, color_light_wall]
+TILE_NOT_DRAWN = 255
+
+#the game messages, a MessageLog created by new_game
+game_msgs = None
+
+#the combat log file, and the events waiting to be written to it
+combat_log = None
+combat_log_lines = []
 
 game_state = 'playing'
 player_action = None
 turn_counter = 0
 
-class Fighter:
+profiling = False
+profile_frame = {}  #seconds spent in each phase during the current frame
+profile_samples = dict((phase, collections.deque(maxlen=PROFILE_WINDOW)) for phase in PROFILE_PHASES)
+profile_turns = 0
+profile_trace = None  #the csv writer of PROFILE_TRACE_FILE, once a turn was profiled
+profile_trace_file = None
+
+#the turns of the awake monsters, as (tick, slot), see monsters_take_turns
+schedule = []
+current_tick = 0
+
+#the RNG of the game itself (levels have their own), seeded by new_game so a game can be replayed
+game_rng = random.Random()
+
+#the file the events are recorded to, and the events of the recording being replayed
+recorder = None
+replay = None
+replay_mismatch = None
+replay_end = None
+
+#top left corner of the camera on the map
+camera_x = 0
+camera_y = 0
+
+#when playing in a world: the chunk at the top left of the window played on (None for a level), the chunks
+#of the window, and the other chunks kept in memory, least recently used first
+world_origin = None
+window_chunks = {}
+chunk_cache = collections.OrderedDict()
+
+#FOVs of the last positions of the player, least recently used first, see update_fov
+fov_cache = collections.OrderedDict()
+
+#the RoomGraph of the current level (None in a world)
+room_graph = None
+
+#levels being generated in the background by level_pool, by seed
+level_pool = None
+pending_levels = {}
+
+#set when the game runs without a window, see run_headless
+headless = False
+
+#the game can also be played in a terminal (see play_terminal): the escape codes that set it up for the game
+#and back, and the libtcod keys for the bytes sent by the terminal. a lone escape byte is the Escape key if
+#nothing follows it within TERMINAL_ESCAPE_DELAY seconds
+TERMINAL_START = '\x1b[?1049h\x1b[?25l\x1b[0m\x1b[2J'
+TERMINAL_END = '\x1b[0m\x1b[?25h\x1b[?1049l'
+TERMINAL_ESCAPE_DELAY = 0.05
+TERMINAL_KEYS = {
+	'\x1b[A': libtcod.KEY_UP, '\x1bOA': libtcod.KEY_UP,
+	'\x1b[B': libtcod.KEY_DOWN, '\x1bOB': libtcod.KEY_DOWN,
+	'\x1b[C': libtcod.KEY_RIGHT, '\x1bOC': libtcod.KEY_RIGHT,
+	'\x1b[D': libtcod.KEY_LEFT, '\x1bOD': libtcod.KEY_LEFT,
+	'\x7f': libtcod.KEY_BACKSPACE, '\x08': libtcod.KEY_BACKSPACE, '\x1b[3~': libtcod.KEY_DELETE,
+	'\x1bOR': libtcod.KEY_F3, '\x1b[13~': libtcod.KEY_F3,
+	'\x1b': libtcod.KEY_ESCAPE,
+}
+
+#the levels of the 6x6x6 color cube of the xterm 256 color palette, that terminal colors are rounded to
+TERMINAL_CUBE_LEVELS = [0, 95, 135, 175, 215, 255]
+
+#the keys that a headless input stream can press, by name
+HEADLESS_KEYS = {
+	'up': libtcod.KEY_UP,
+	'down': libtcod.KEY_DOWN,
+	'left': libtcod.KEY_LEFT,
+	'right': libtcod.KEY_RIGHT,
+	'zap': libtcod.KEY_BACKSPACE,
+}
+
+class EntityStore:
+	#the data of all the objects of the current level, in parallel arrays indexed by the slot of each object.
+	#Object and its components only keep a slot number (or their owner) and read and write the arrays through
+	#properties, so a monster costs a few small slotted instances instead of several dicts, and the hot loops
+	#can go through the arrays directly
+	FIELDS = ['x', 'y', 'hp', 'max_hp', 'defense', 'power', 'mp', 'max_mp', 'state', 'last_x', 'last_y', 'speed', 'awake',
+		'alert', 'route']
+
+	def __init__(self):
+		for field in self.FIELDS:
+			setattr(self, field, array.array('i'))
+		self.objects = []  #the object in each slot
+
+	def add(self, obj):
+		#give an object the next slot, with all its fields at 0 except for a normal speed
+		for field in self.FIELDS:
+			getattr(self, field).append(0)
+		self.speed[-1] = NORMAL_SPEED
+		self.objects.append(obj)
+		return len(self.objects) - 1
+
+	def compact(self, keep):
+		#forget all the objects except the ones in keep, which get new slots, in the same order
+		rows = [[getattr(self, field)[obj.slot] for field in self.FIELDS] for obj in keep]
+		self.__init__()
+		for (obj, row) in zip(keep, rows):
+			obj.slot = self.add(obj)
+			for (field, value) in zip(self.FIELDS, row):
+				getattr(self, field)[obj.slot] = value
+
+entities = EntityStore()
+
+
+class Layer(object):
+	#a collection of objects with O(1) add and remove, iterated in the order they were added (which is
+	#also the drawing order). the objects of a level are split in layers: objects, the actors that can act
+	#or block, and corpses, the remains that are only drawn
+	__slots__ = ('items',)
+
+	def __init__(self, objs=()):
+		self.items = collections.OrderedDict((obj, None) for obj in objs)
+
+	def append(self, obj):
+		self.items[obj] = None
+
+	def remove(self, obj):
+		del self.items[obj]
+
+	def __iter__(self):
+		return iter(self.items)
+
+	def __len__(self):
+		return len(self.items)
+
+	def __contains__(self, obj):
+		return obj in self.items
+
+def owner_field(field):
+	#a property of a component, for one of the entity fields at the slot of its owner
+	def get(self):
+		return getattr(entities, field)[self.owner.slot]
+	def set(self, value):
+		getattr(entities, field)[self.owner.slot] = value
+	return property(get, set)
+
+
+class Fighter(object):
 	#combat-related properties and methods (monster, player, NPC).
+	__slots__ = ('owner', 'death_function', 'stats')
+
 	def __init__(self, hp, defense, power, death_function=None):
 		self.death_function = death_function		
-		self.max_hp = hp
-		self.hp = hp
-		self.defense = defense
-		self.power = power
+		self.stats = (hp, defense, power)  #until attach moves them to the entity arrays
+
+	def attach(self, owner):
+		#let the fighter know who owns it, and give the owner its stats
+		self.owner = owner
+		(self.hp, self.defense, self.power) = self.stats
+		self.max_hp = self.hp
+		self.stats = None
+
+	hp = owner_field('hp')
+	max_hp = owner_field('max_hp')
+	defense = owner_field('defense')
+	power = owner_field('power')
 
 	def take_damage(self, damage):
         #apply damage if possible
@@ -68,21 +341,34 @@ class Fighter:
 					function(self.owner)				
 
 	def attack(self, target):
+		#fights are loud
+		make_noise(self.owner.x, self.owner.y, COMBAT_NOISE_RADIUS)
+
         #a simple formula for attack damage
 		damage = self.power - target.fighter.defense
  
 		if damage > 0:
             #make the target take some damage
-			message(self.owner.name.capitalize() + ' attacks ' + target.name + ' for ' + str(damage) + ' hit points.')
+			log_event('attack', self.owner.name, target.name, damage)
 			target.fighter.take_damage(damage)
 		else:
-			message(self.owner.name.capitalize() + ' attacks ' + target.name + ' but it has no effect!')
+			log_event('miss', self.owner.name, target.name)
+
 
+class Mage(object):
+	__slots__ = ('owner', 'stats')
 
-class Mage:
 	def __init__(self, mp):
-		self.mp = mp
-		self.max_mp = mp
+		self.stats = mp  #until attach moves it to the entity arrays
+
+	def attach(self, owner):
+		#let the mage know who owns it, and give the owner its magic points
+		self.owner = owner
+		self.mp = self.max_mp = self.stats
+		self.stats = None
+
+	mp = owner_field('mp')
+	max_mp = owner_field('max_mp')
 
 	def cast_lightning(self):
 		if self.mp <= 1:
@@ -95,9 +381,9 @@ class Mage:
 			return 'cancelled'
  
     	#zap it!
-		damage = 2*libtcod.random_get_int(0, 1, LIGHTNING_MAX_DAMAGE)    
-		message('A lighting bolt strikes the ' + monster.name + ' with a loud thunder! The damage is '
-			+ str(damage) + ' hit points.', libtcod.light_blue)
+		damage = 2*game_rng.randint(1, LIGHTNING_MAX_DAMAGE)    
+		log_event('zap', self.owner.name, monster.name, damage)
+		make_noise(monster.x, monster.y, THUNDER_NOISE_RADIUS)
 		monster.fighter.take_damage(damage)
 		self.mp -= 2
 
@@ -106,17 +392,31 @@ class Mage:
 			self.mp += 1
 
 
-class BasicMonster:
+class BasicMonster(object):
 	#AI for a basic monster.
-	def __init__(self):
+	__slots__ = ('owner',)
+
+	def attach(self, owner):
+		#let the AI know who owns it, and start flocking
+		self.owner = owner
 		self.state = 'flocking'
 		self.last_x = 0
 		self.last_y = 0
 
+	def get_state(self):
+		return AI_STATES[entities.state[self.owner.slot]]
+
+	def set_state(self, state):
+		entities.state[self.owner.slot] = AI_STATES.index(state)
+
+	state = property(get_state, set_state)
+	last_x = owner_field('last_x')
+	last_y = owner_field('last_y')
+
 	def take_turn(self):
         #a basic monster takes its turn. If you can see it, it can see you
 		monster = self.owner
-		if libtcod.map_is_in_fov(fov_map, monster.x, monster.y):
+		if in_fov(monster.x, monster.y):
  
 			self.state = 'chasing'
 			self.last_x = player.x
@@ -124,7 +424,7 @@ class BasicMonster:
 
             #move towards player if far away
 			if monster.distance_to(player) >= 2:
-				monster.move_astar(player)
+				monster.move_to_player()
  
             #close enough, attack! (if the player is still alive.)
 			elif player.fighter.hp > 0:
@@ -135,18 +435,11 @@ class BasicMonster:
 			if monster.x == self.last_x and monster.y == self.last_y:
 				self.state = 'flocking'
 			else:
-				monster.move_towards(self.last_x, self.last_y)
+				monster.move_far(self.last_x, self.last_y)
 
 		#Default behaviour, flock into attack group with neighbouring monsters
 		elif self.state == 'flocking':
-			closest_dist = MONSTER_GROUP_RANGE
-			closest_monster = None			
-			for object in objects:
-				if object.fighter and not object == player and not object == monster:
-					dist = monster.distance_to(object)
-					if dist < closest_dist:  #it's closer, so remember it
-						closest_monster = object
-						closest_dist = dist
+			closest_monster = closest_fighter(monster, MONSTER_GROUP_RANGE)
 
 			if closest_monster != None:
 				if monster.distance_to(closest_monster) >= 2:
@@ -171,20 +464,383 @@ class Rect:
 		return (self.x1 <= other.x2 and self.x2 >= other.x1 and self.y1 <= other.y2 and self.y2 >= other.y1)
 
 
+class RoomGrid:
+    #the rooms of a level bucketed by the cells of a coarse grid they overlap. a room can only intersect the
+    #rooms that share a cell with it, and as rooms are no bigger than a cell there are only a few of those
+	def __init__(self):
+		self.cell_size = ROOM_MAX_SIZE + 1
+		self.cells = {}
+
+	def cells_of(self, rect):
+		size = self.cell_size
+		for cx in range(rect.x1 / size, rect.x2 / size + 1):
+			for cy in range(rect.y1 / size, rect.y2 / size + 1):
+				yield (cx, cy)
+
+	def intersect(self, rect):
+		#returns true if the rectangle intersects with a room of the grid
+		for cell in self.cells_of(rect):
+			for room in self.cells.get(cell, ()):
+				if rect.intersect(room):
+					return True
+		return False
+
+	def add(self, rect):
+		for cell in self.cells_of(rect):
+			self.cells.setdefault(cell, []).append(rect)
+
+
+class FreeCells:
+    #the cells of a grid that have no room yet, each big enough for any room plus a wall between it and the
+    #next cell's room. a room drawn in a free cell always fits, so no try is wasted
+	def __init__(self, rng, width, height):
+		self.rng = rng
+		self.cell_size = ROOM_MAX_SIZE + 2
+		(columns, rows) = ((width + 1) / self.cell_size, (height + 1) / self.cell_size)
+		self.free = [(cx, cy) for cx in range(columns) for cy in range(rows)]
+
+	def room(self, w, h):
+		#take a random free cell and return a room of the given size somewhere in it, or None if all are taken
+		if not self.free:
+			return None
+		i = libtcod.random_get_int(self.rng, 0, len(self.free) - 1)
+		(cx, cy) = self.free[i]
+		self.free[i] = self.free[-1]
+		self.free.pop()
+		(x0, y0) = (cx * self.cell_size, cy * self.cell_size)
+		x = libtcod.random_get_int(self.rng, x0, x0 + self.cell_size - 2 - w)
+		y = libtcod.random_get_int(self.rng, y0, y0 + self.cell_size - 2 - h)
+		return Rect(x, y, w, h)
+
+
+
+class Level:
+    #a generated level: its tiles, its rooms, where the player starts and the monsters as (kind, x, y).
+    #it holds no libtcod objects or game objects, so it can be built in another process and cached on disk
+	def __init__(self, seed, tiles):
+		self.seed = seed
+		self.tiles = tiles
+		self.rooms = []
+		self.links = []  #the tunnels between rooms, see RoomGraph
+		self.start = None
+		self.monsters = []
+		self.monster_positions = set()
+
+	def is_blocked(self, x, y):
+		#same as is_blocked, for a level that is still being generated
+		if self.tiles.blocked[x * self.tiles.height + y]:
+			return True
+		return (x, y) == self.start or (x, y) in self.monster_positions
+
+	def add_monster(self, kind, x, y):
+		self.monsters.append((kind, x, y))
+		self.monster_positions.add((x, y))
+
+
+class RoomGraph:
+    #the rooms of a level and the tunnels that make_map dug between them, for the moves of monsters that are too
+    #far from their target for A*. a tunnel (a link) goes from the center of room a straight to a corner, then
+    #straight to the center of room b, through any room in the way: the rooms it goes through are its stops,
+    #and two rooms are neighbours when they are next to each other on a link. a monster in a room heads for
+    #the stop towards the target on the graph, so it only ever needs a path to a tile in sight: see waypoint
+	def __init__(self, width, height, rooms, links):
+		self.width = width
+		self.height = height
+		self.rooms = rooms
+		self.links = links
+		self.centers = [room.center() for room in rooms]
+		self.fields = collections.OrderedDict()
+		self.doors = {}
+
+		#for every tile, the room it is inside (or -1) and the last link whose tunnel goes through it (or -1).
+		#tunnels cross and overlap a lot, so that is only one of them: a monster remembers the link it follows.
+		#also finds the stops of every link, as (first, last tile in the room, room) in tiles from room a, and
+		#the neighbours of every room, as (room, link, whether it is forward on the link, length)
+		self.room_at = array.array('i', [-1]) * (width * height)
+		self.link_at = array.array('i', [-1]) * (width * height)
+		for (i, room) in enumerate(rooms):
+			for x in range(room.x1 + 1, room.x2):
+				self.room_at[x * height + room.y1 + 1:x * height + room.y2] = array.array('i', [i]) * (room.y2 - room.y1 - 1)
+
+		self.stops = []
+		self.neighbours = [[] for room in rooms]
+		for (i, (a, b, corner)) in enumerate(links):
+			spans = {}
+			s = 0  #where the leg starts on the link
+			for (start, end) in ((self.centers[a], corner), (corner, self.centers[b])):
+				(x1, x2, y1, y2) = (min(start[0], end[0]), max(start[0], end[0]), min(start[1], end[1]), max(start[1], end[1]))
+				if x1 == x2:
+					leg = slice(x1 * height + y1, x1 * height + y2 + 1)
+				else:
+					leg = slice(x1 * height + y1, x2 * height + y1 + 1, height)
+				self.link_at[leg] = array.array('i', [i]) * (x2 - x1 + y2 - y1 + 1)
+				for room in set(self.room_at[leg]):
+					if room != -1:
+						#the tiles of the leg inside the room
+						r = self.rooms[room]
+						inside = ((max(x1, r.x1 + 1), max(y1, r.y1 + 1)), (min(x2, r.x2 - 1), min(y2, r.y2 - 1)))
+						(first, last) = sorted(s + self.length(start, tile) for tile in inside)
+						if room in spans:
+							(first, last) = (min(first, spans[room][0]), max(last, spans[room][1]))
+						spans[room] = (first, last)
+				s += self.length(start, end)
+			stops = sorted((first, last, room) for (room, (first, last)) in spans.items())
+			self.stops.append(stops)
+			for ((first, last, room), (next_first, next_last, next_room)) in zip(stops, stops[1:]):
+				length = (next_first + next_last) / 2 - (first + last) / 2
+				self.neighbours[room].append((next_room, i, 1, length))
+				self.neighbours[next_room].append((room, i, 0, length))
+
+	def length(self, start, end):
+		#the length of a tunnel between two of its tiles, as tunnels never turn back
+		return abs(start[0] - end[0]) + abs(start[1] - end[1])
+
+	def position(self, link, x, y):
+		#how far a tile of a link's tunnel is from room a
+		return self.length(self.centers[self.links[link][0]], (x, y))
+
+	def tile(self, link, s):
+		#the tile of a link's tunnel that far from room a
+		(a, b, (cx, cy)) = self.links[link]
+		((ax, ay), (bx, by)) = (self.centers[a], self.centers[b])
+		first_leg = self.length((ax, ay), (cx, cy))
+		if s <= first_leg:
+			return (ax + cmp(cx, ax) * s, ay + cmp(cy, ay) * s)
+		return (cx + cmp(bx, cx) * (s - first_leg), cy + cmp(by, cy) * (s - first_leg))
+
+	def around(self, link, s):
+		#the stops of a link just before and after a tile of its tunnel outside the rooms (None for none)
+		(before, after) = (None, None)
+		for stop in self.stops[link]:
+			if stop[1] < s:
+				before = stop
+			elif stop[0] > s:
+				after = stop
+				break
+		return (before, after)
+
+	def on_link(self, link, x, y):
+		#whether a tile is on a link's tunnel
+		(a, b, corner) = self.links[link]
+		for (x1, y1) in (self.centers[a], self.centers[b]):
+			if min(x1, corner[0]) <= x <= max(x1, corner[0]) and min(y1, corner[1]) <= y <= max(y1, corner[1]):
+				return True
+		return False
+
+	def on_first_leg(self, link, x, y):
+		#whether a tile of a link's tunnel is before its corner, coming from room a
+		(a, b, corner) = self.links[link]
+		start = self.centers[a]
+		return (x, y) != corner and start != corner and (x == start[0] == corner[0] or y == start[1] == corner[1])
+
+	def along(self, link, x, y, target):
+		#the next tile to head for along a link's tunnel, from one of its tiles to another one
+		corner = self.links[link][2]
+		if (x, y) != corner and target != corner and self.on_first_leg(link, x, y) != self.on_first_leg(link, *target):
+			return corner
+		return target
+
+	def field(self, target, room):
+		#the distance along the graph from a room to the room target, and the way it is left by to get there, as
+		#(link, forward) (None in the target), or (None, None) if the target cannot be reached. the field of a
+		#target is only computed as far as the rooms asked about (Dijkstra from the target), and goes on from there
+		#for the next ones
+		if target in self.fields:
+			field = self.fields.pop(target)
+		else:
+			field = ({target: 0}, {target: None}, set(), [(0, target)])
+			if len(self.fields) >= ROOM_FIELD_CACHE_SIZE:
+				self.fields.popitem(last=False)
+		self.fields[target] = field
+		(dist, via, done, frontier) = field
+		while room not in done and frontier:
+			(d, here) = heapq.heappop(frontier)
+			if here in done:
+				continue  #already reached by a shorter way
+			done.add(here)
+			for (other, link, forward, length) in self.neighbours[here]:
+				if other not in done and (other not in dist or d + length < dist[other]):
+					dist[other] = d + length
+					via[other] = (link, 1 - forward)
+					heapq.heappush(frontier, (d + length, other))
+		if room not in done:
+			return (None, None)
+		return (dist[room], via[room])
+
+	def way(self, room, there, link, x, y):
+		#the distance along the graph from a room to (x, y), which is in the room there or else in a link's tunnel,
+		#and the way the room is left by to get there, as (link, forward), or (None, None). a tile in a tunnel is
+		#reached from the stops on both sides of it, so the fields are only ever those of rooms
+		if there >= 0:
+			return self.field(there, room)
+		s = self.position(link, x, y)
+		ways = []
+		for (stop, forward) in zip(self.around(link, s), (1, 0)):
+			if stop is not None:
+				(dist, via) = self.field(stop[2], room)
+				if dist is not None:
+					ways.append((dist + abs(s - (stop[0] + stop[1]) / 2), via or (link, forward)))
+		return min(ways) if ways else (None, None)
+
+	def door(self, room, link, forward):
+		#where a link's tunnel leaves one of its stops, going forward or back: its last tile in the room
+		if (room, link, forward) not in self.doors:
+			for (first, last, stop) in self.stops[link]:
+				if stop == room:
+					self.doors[(room, link, forward)] = last if forward else first
+		return self.doors[(room, link, forward)]
+
+	def waypoint(self, x, y, target_x, target_y, route):
+		#the tile to head for from (x, y) to get to (target_x, target_y), and the route to remember for the next
+		#move, or (None, 0) if the graph does not know. a route is 0, or 1 + 2 * a link + whether the monster
+		#goes forward on it. in a room, a monster heads out of it on the link towards the target; in a tunnel it
+		#keeps following its route to the next room. every room it gets to is closer to the target, so it never
+		#goes round in circles
+		room_at = self.room_at
+		(room, there) = (room_at[x * self.height + y], room_at[target_x * self.height + target_y])
+		target_link = self.link_at[target_x * self.height + target_y]
+		if there == -1 and target_link == -1:
+			return (None, 0)
+		if room >= 0 and room == there:
+			return ((target_x, target_y), 0)
+
+		link = None
+		if room == -1 and route:
+			(link, forward) = divmod(route - 1, 2)
+			if not self.on_link(link, x, y):
+				link = None
+		if room == -1 and link is None:
+			#in a tunnel without a route: go on to its stop closest to the target
+			link = self.link_at[x * self.height + y]
+			if link == -1:
+				return (None, 0)
+			s = self.position(link, x, y)
+			ways = []
+			if there == -1 and link == target_link:
+				target_s = self.position(link, target_x, target_y)
+				ways.append((abs(target_s - s), int(target_s > s)))
+			for (stop, forward) in zip(self.around(link, s), (0, 1)):
+				if stop is not None:
+					dist = self.way(stop[2], there, target_link, target_x, target_y)[0]
+					if dist is not None:
+						ways.append((dist + abs((stop[0] + stop[1]) / 2 - s), forward))
+			if not ways:
+				return (None, 0)
+			forward = min(ways)[1]
+		if room == -1:
+			if there == -1 and link == target_link:
+				return (self.along(link, x, y, (target_x, target_y)), 1 + 2 * link + forward)
+			return (self.along(link, x, y, self.centers[self.links[link][forward]]), 1 + 2 * link + forward)
+
+		(dist, via) = self.way(room, there, target_link, target_x, target_y)
+		if via is None:
+			return (None, 0)
+		#go to the tile the tunnel leaves the room from, then out: a monster heading straight for the tile out
+		#could cut the corner of the room into another tunnel
+		(link, forward) = via
+		s = self.door(room, link, forward)
+		if (x, y) == self.tile(link, s):
+			s += 1 if forward else -1
+		return (self.tile(link, s), 1 + 2 * link + forward)
+
+
+class Chunk:
+    #a piece of the world: its tiles, the center of its first room, where the tunnels to its neighbours start,
+    #and its objects as records (see object_record) relative to its top left corner
+	def __init__(self, tiles, start, records):
+		self.tiles = tiles
+		self.start = start
+		self.records = records
+
+
+#translation table that turns 0 into 1 and everything else into 0
+INVERT = bytearray([1] + [0] * 255)
+
+class TileMap:
+    #the tiles of the map, stored column by column in two flat arrays: tile (x, y) is at index x * height + y
+	def __init__(self, width, height, blocked = True):
+		self.width = width
+		self.height = height
+		self.blocked = bytearray([blocked]) * (width * height)
+		self.block_sight = bytearray([blocked]) * (width * height)
+
+	def __getitem__(self, x):
+		#map[x][y] still gives a tile with blocked and block_sight properties
+		return TileColumn(self, x)
+
+	def carve(self, x1, y1, x2, y2):
+		#make the tiles with x1 <= x < x2 and y1 <= y < y2 passable and transparent
+		h = self.height
+		if x2 - x1 <= y2 - y1:
+			#one contiguous run per column
+			run = bytearray(y2 - y1)
+			for x in range(x1, x2):
+				self.blocked[x * h + y1:x * h + y2] = run
+				self.block_sight[x * h + y1:x * h + y2] = run
+		else:
+			#one strided run per row
+			run = bytearray(x2 - x1)
+			for y in range(y1, y2):
+				self.blocked[x1 * h + y:x2 * h + y:h] = run
+				self.block_sight[x1 * h + y:x2 * h + y:h] = run
+
+	def paste(self, other, x, y):
+		#copy the tiles of another map into this one, with its top left corner at (x, y)
+		for i in range(other.width):
+			start = (x + i) * self.height + y
+			self.blocked[start:start + other.height] = other.blocked[i * other.height:(i + 1) * other.height]
+			self.block_sight[start:start + other.height] = other.block_sight[i * other.height:(i + 1) * other.height]
+
+	def load_into(self, tcod_map):
+		#set the properties of a libtcod map in one pass: clear it to walls, then only visit the open tiles
+		libtcod.map_clear(tcod_map, False, False)
+		h = self.height
+		for i in itertools.compress(itertools.count(), self.blocked.translate(INVERT)):
+			libtcod.map_set_properties(tcod_map, i / h, i % h, not self.block_sight[i], True)
+		for i in itertools.compress(itertools.count(), self.block_sight.translate(INVERT)):
+			if self.blocked[i]:
+				libtcod.map_set_properties(tcod_map, i / h, i % h, True, False)
+
+class TileColumn:
+	#one column of the map, so that map[x][y] works
+	def __init__(self, tiles, x):
+		self.tiles = tiles
+		self.x = x
+
+	def __getitem__(self, y):
+		return Tile(self.tiles, self.x * self.tiles.height + y)
+
+class Tile(object):
+    #a tile of the map and its properties, read from and written to the arrays of its TileMap
+	__slots__ = ('tiles', 'i')
 
-class Tile:
-    #a tile of the map and its properties
-	def __init__(self, blocked, block_sight = None):
-		self.blocked = blocked
- 
-        #by default, if a tile is blocked, it also blocks sight
-		if block_sight is None: block_sight = blocked
-		self.block_sight = block_sight
+	def __init__(self, tiles, i):
+		self.tiles = tiles
+		self.i = i
+
+	def get_blocked(self):
+		return bool(self.tiles.blocked[self.i])
 
-class Object:
+	def set_blocked(self, blocked):
+		self.tiles.blocked[self.i] = bool(blocked)
+
+	def get_block_sight(self):
+		return bool(self.tiles.block_sight[self.i])
+
+	def set_block_sight(self, block_sight):
+		self.tiles.block_sight[self.i] = bool(block_sight)
+
+	blocked = property(get_blocked, set_blocked)
+	block_sight = property(get_block_sight, set_block_sight)
+
+class Object(object):
     #this is a generic object: the player, a monster, an item, the stairs...
     #it's always represented by a character on screen.
+    #its position, and the data of its components, are kept in the entity arrays at its slot
+	__slots__ = ('slot', 'name', 'blocks', 'char', 'color', 'fighter', 'ai', 'mage')
+
 	def __init__(self, x, y, char, name, color, blocks=False, fighter=None, ai=None, mage=None):
+		self.slot = entities.add(self)
 		self.name = name
 		self.blocks = blocks
 		self.x = x
@@ -193,32 +849,46 @@ class Object:
 		self.color = color
 		self.fighter = fighter
 		if self.fighter:  #let the fighter component know who owns it
-			self.fighter.owner = self
+			self.fighter.attach(self)
  
 		self.ai = ai
 		if self.ai:  #let the AI component know who owns it
-			self.ai.owner = self	
+			self.ai.attach(self)	
 
 		self.mage = mage
 		if self.mage:  #let the mage component know who owns it
-			self.mage.owner = self				
+			self.mage.attach(self)				
+
+	def get_x(self):
+		return entities.x[self.slot]
+
+	def set_x(self, x):
+		entities.x[self.slot] = x
+
+	def get_y(self):
+		return entities.y[self.slot]
+
+	def set_y(self, y):
+		entities.y[self.slot] = y
+
+	x = property(get_x, set_x)
+	y = property(get_y, set_y)
  
 	def move(self, dx, dy):
         #move by the given amount
  		if not is_blocked(self.x + dx, self.y + dy):     
-			self.x += dx
-			self.y += dy
- 
-	def draw(self):
-        #set the color and then draw the character that represents this object at its position
-		if libtcod.map_is_in_fov(fov_map, self.x, self.y):
-			libtcod.console_set_default_foreground(con, self.color)
-			libtcod.console_put_char(con, self.x, self.y, self.char, libtcod.BKGND_NONE)
+			self.place(self.x + dx, self.y + dy)
+
+	def place(self, x, y):
+		#put this object at the given position, keeping the navigation map in sync
+		if self.blocks:
+			nav_set_blocked(self.x, self.y, False)
+			nav_set_blocked(x, y, True)
+		unindex_object(self)
+		self.x = x
+		self.y = y
+		index_object(self)
  
-	def clear(self):
-        #erase the character that represents this object
-		libtcod.console_put_char(con, self.x, self.y, ' ', libtcod.BKGND_NONE)
-
 	def move_towards(self, target_x, target_y):
         #vector from this object to the target, and distance
 		dx = target_x - self.x
@@ -237,54 +907,95 @@ class Object:
 		dy = other.y - self.y
 		return math.sqrt(dx ** 2 + dy ** 2)
 
-	def send_to_back(self):
-        #make this object be drawn first, so all others appear above it if they're in the same tile.
-		global objects
-		objects.remove(self)
-		objects.insert(0, self)		
+	def move_to_player(self):
+		#step to the free neighbouring tile that is closest to the player on the shared chase field
+		update_chase_field()
+		here = chase_field.get((self.x, self.y))
+		if here is None:
+			#too far away for the field
+			self.move_far(player.x, player.y)
+			return
+
+		best_step = None
+		best_dist = here
+		for (dx, dy, cost) in NEIGHBOUR_STEPS:
+			dist = chase_field.get((self.x + dx, self.y + dy))
+			if dist is not None and dist < best_dist and not is_blocked(self.x + dx, self.y + dy):
+				best_step = (dx, dy)
+				best_dist = dist
+
+		if best_step is None:
+			#every way closer is taken (for example by other monsters in a corridor), just push towards the player
+			self.move_towards(player.x, player.y)
+		else:
+			self.move(*best_step)
+
+	def step_towards(self, target_x, target_y):
+		#step to the free neighbouring tile closest to the target, if one is closer than here. unlike
+		#move_towards, this goes along a wall in the way instead of bumping into it
+		def closeness(x, y):
+			(dx, dy) = (abs(target_x - x), abs(target_y - y))
+			return (max(dx, dy), dx * dx + dy * dy)
+		best = closeness(self.x, self.y)
+		best_step = None
+		for (dx, dy, cost) in NEIGHBOUR_STEPS:
+			distance = closeness(self.x + dx, self.y + dy)
+			if distance < best and not is_blocked(self.x + dx, self.y + dy):
+				(best, best_step) = (distance, (dx, dy))
+		if best_step is not None:
+			self.move(*best_step)
+
+	def move_far(self, target_x, target_y):
+		#move towards a target too far for A*: through the rooms and tunnels of the room graph, one waypoint in
+		#sight at a time. without a graph (in a world), or off it, just move towards the target
+		waypoint = None
+		if room_graph is not None:
+			(waypoint, entities.route[self.slot]) = room_graph.waypoint(self.x, self.y, target_x, target_y,
+				entities.route[self.slot])
+		if waypoint is None:
+			self.move_towards(target_x, target_y)
+		else:
+			self.step_towards(*waypoint)
 
 	def move_astar(self, target):
-		#Create a FOV map that has the dimensions of the map
-		fov = libtcod.map_new(MAP_WIDTH, MAP_HEIGHT)
- 
-        #Scan the current map each turn and set all the walls as unwalkable
-		for y1 in range(MAP_HEIGHT):
-			for x1 in range(MAP_WIDTH):
-				libtcod.map_set_properties(fov, x1, y1, not map[x1][y1].block_sight, not map[x1][y1].blocked)
- 
-        #Scan all the objects to see if there are objects that must be navigated around
-        #Check also that the object isn't self or the target (so that the start and the end points are free)
-        #The AI class handles the situation if self is next to the target so it will not use this A* function anyway   
-		for obj in objects:
-			if obj.blocks and obj != self and obj != target:
-                #Set the tile as a wall so it must be navigated around
-				libtcod.map_set_properties(fov, obj.x, obj.y, True, False)
- 
-        #Allocate a A* path
-        #The 1.41 is the normal diagonal cost of moving, it can be set as 0.0 if diagonal moves are prohibited
-		my_path = libtcod.path_new_using_map(fov, 1.41)
- 
+		#Use the shared navigation map, which already has the walls and the blocking objects set as unwalkable.
+		#Only free the start and the end points for this query, so that a path between them can exist.
+		#The AI class handles the situation if self is next to the target so it will not use this A* function anyway
+		start = profile_clock()
+		if max(abs(target.x - self.x), abs(target.y - self.y)) >= ASTAR_MAX_PATH:
+			#no path can be short enough, don't search the whole map for one
+			self.move_far(target.x, target.y)
+			profile_lap('astar', start)
+			return
+		nav_set_blocked(self.x, self.y, False)
+		nav_set_blocked(target.x, target.y, False)
+
         #Compute the path between self's coordinates and the target's coordinates
-		libtcod.path_compute(my_path, self.x, self.y, target.x, target.y)
- 
+        #The path was allocated once with a diagonal cost of 1.41, it can be set as 0.0 if diagonal moves are prohibited
+		libtcod.path_compute(nav_path, self.x, self.y, target.x, target.y)
+
         #Check if the path exists, and in this case, also the path is shorter than 25 tiles
         #The path size matters if you want the monster to use alternative longer paths (for example through other rooms) if for example the player is in a corridor
         #It makes sense to keep path size relatively low to keep the monsters from running around the map if there's an alternative path really far away        
-		if not libtcod.path_is_empty(my_path) and libtcod.path_size(my_path) < 25:
+		path_found = not libtcod.path_is_empty(nav_path) and libtcod.path_size(nav_path) < ASTAR_MAX_PATH
+		if path_found:
             #Find the next coordinates in the computed full path
-			x, y = libtcod.path_walk(my_path, True)
-			if x or y:
-                #Set self's coordinates to the next path tile
-				self.x = x
-				self.y = y
-		else:
-            #Keep the old move function as a backup so that if there are no paths (for example another monster blocks a corridor)
-            #it will still try to move towards the player (closer to the corridor opening)
-			self.move_towards(target.x, target.y)  
- 
-        #Delete the path to free memory
-		libtcod.path_delete(my_path)
+			x, y = libtcod.path_walk(nav_path, True)
+
+		#Block the start and the end points again before anything moves
+		if self.blocks:
+			nav_set_blocked(self.x, self.y, True)
+		if target.blocks:
+			nav_set_blocked(target.x, target.y, True)
 
+		if not path_found:
+            #Keep the old move function as a backup so that if there are no paths (for example another monster blocks a corridor)
+            #it will still try to move towards the player (closer to the corridor opening), through the rooms if far away
+			self.move_far(target.x, target.y)
+		elif x or y:
+            #Set self's coordinates to the next path tile
+			self.place(x, y)
+		profile_lap('astar', start)
 
 
 
@@ -296,8 +1007,8 @@ def target_monster(max_range=None):
 			return None
 
         #return the first clicked monster, otherwise continue looping
-		for obj in objects:     	
-			if obj.x == x and obj.y == y and obj.fighter and obj != player:
+		for obj in objects_at(x, y):
+			if obj.fighter and obj != player:
 				dist = player.distance_to(obj)   				
 				if dist > max_range or dist <= 1:
 					return None				
@@ -308,19 +1019,37 @@ def target_monster(max_range=None):
 def target_tile(max_range=None):
     #return the position of a tile left-clicked in player's FOV (optionally in a range), or (None,None) if right-clicked.
 	global key, mouse   
+	if headless and replay is None:
+		return headless_target(max_range)
+
 	while True:
         #render the screen. this erases the inventory and shows the names of objects under the mouse.
-		libtcod.console_flush()
-		libtcod.sys_check_for_event(libtcod.EVENT_KEY_PRESS|libtcod.EVENT_MOUSE,key,mouse)
-		render_all()
+		if not headless and render_all():
+			libtcod.console_flush()
+
+		#sleep until the mouse moves or clicks, or a key is pressed
+		if not wait_for_event():
+			return (None, None)
  
-		(x, y) = (mouse.cx, mouse.cy)
+		(x, y) = (camera_x + mouse.cx, camera_y + mouse.cy)
  
 		if mouse.lbutton_pressed:
 			return (x, y)
 		elif mouse.rbutton_pressed:
 			return (None, None)
 
+def headless_target(max_range):
+	#there is no mouse without a window, so aim at the closest monster in FOV that is in range, or cancel
+	target = None
+	for obj in objects:
+		if obj.fighter and obj != player and in_fov(obj.x, obj.y):
+			dist = player.distance_to(obj)
+			if 1 < dist <= max_range and (target is None or dist < player.distance_to(target)):
+				target = obj
+	if target is None:
+		return (None, None)
+	return (target.x, target.y)
+
 def player_death(player):
     #the game ended!
 	global game_state
@@ -332,17 +1061,100 @@ def player_death(player):
 	player.color = libtcod.dark_red
  
 
+#the text of each kind of event, once and when merged with the same event happening again in the turn, and
+#its color. %(actor)s is capitalized, and %(actors)s is the plural of the actor
+EVENT_TEXTS = {
+	'attack': ('%(actor)s attacks %(target)s for %(amount)d hit points.',
+		'%(count)d %(actors)s attack %(target)s for %(amount)d hit points in total.', libtcod.white),
+	'miss': ('%(actor)s attacks %(target)s but it has no effect!',
+		'%(count)d %(actors)s attack %(target)s but it has no effect!', libtcod.white),
+	'zap': ('A lighting bolt strikes the %(target)s with a loud thunder! The damage is %(amount)d hit points.',
+		'%(count)d lighting bolts strike the %(target)s with a loud thunder! The damage is %(amount)d hit points.',
+		libtcod.light_blue),
+	'death': ('%(actor)s is dead!', '%(count)d %(actors)s are dead!', libtcod.white),
+}
+
+class MessageLog(object):
+	#the game messages, as a ring buffer of the last MSG_LOG_SIZE entries. an entry is a kind of event (None
+	#for a plain message), its actor, target and amount, how many times it happened and its color. it is
+	#only formatted and wrapped once it is shown, and an event happening again in the same turn (orcs
+	#attacking the player...) is merged into the first entry instead of adding a new one
+	__slots__ = ('entries', 'turn', 'turn_entries', 'version')
+
+	def __init__(self, entries=()):
+		self.entries = collections.deque(maxlen=MSG_LOG_SIZE)
+		for (verb, actor, target, amount, count, color) in entries:
+			self.entries.append([verb, actor, target, amount, count, color, None])
+		self.turn = None
+		self.turn_entries = {}
+		self.version = 0  #changes with every message, so the panel is only drawn again when it changed
+
+	def add(self, verb, actor, target, amount, color):
+		self.version += 1
+		if verb is not None:
+			if self.turn != current_tick:
+				self.turn = current_tick
+				self.turn_entries = {}
+			entry = self.turn_entries.get((verb, actor, target))
+			if entry is not None:
+				entry[3] += amount
+				entry[4] += 1
+				entry[6] = None
+				return
+		entry = [verb, actor, target, amount, 1, color, None]
+		self.entries.append(entry)
+		if verb is not None:
+			self.turn_entries[(verb, actor, target)] = entry
+
+	def lines(self):
+		#the last MSG_HEIGHT lines, as (text, color)
+		lines = []
+		for entry in reversed(self.entries):
+			if entry[6] is None:
+				(verb, actor, target, amount, count, color) = entry[:6]
+				if verb is None:
+					text = actor
+				else:
+					names = {'actor': actor.capitalize(), 'actors': actor + 's', 'target': target,
+						'amount': amount, 'count': count}
+					text = EVENT_TEXTS[verb][count > 1] % names
+				entry[6] = [(line, color) for line in textwrap.wrap(text, MSG_WIDTH)]
+			lines[:0] = entry[6]
+			if len(lines) >= MSG_HEIGHT:
+				break
+		return lines[-MSG_HEIGHT:]
+
+	def state(self):
+		#the entries without their formatted lines, with colors as (r, g, b)
+		return [(verb, actor, target, amount, count, (color.r, color.g, color.b))
+			for (verb, actor, target, amount, count, color, lines) in self.entries]
+
 def message(new_msg, color = libtcod.white):
-	#split the message if necessary, among multiple lines
-	new_msg_lines = textwrap.wrap(new_msg, MSG_WIDTH)
- 
-	for line in new_msg_lines:
-        #if the buffer is full, remove the first line to make room for the new one
-		if len(game_msgs) == MSG_HEIGHT:
-			del game_msgs[0]
- 
-        #add the new line as a tuple, with the text and the color
-		game_msgs.append( (line, color) )
+	#add a plain message to the log
+	game_msgs.add(None, new_msg, None, 0, color)
+
+def log_event(verb, actor, target=None, amount=0):
+	#add an event (one of EVENT_TEXTS) to the log, and to the combat log file if there is one
+	game_msgs.add(verb, actor, target, amount, EVENT_TEXTS[verb][2])
+	if combat_log is not None:
+		combat_log_lines.append('%d\t%s\t%s\t%s\t%d\n' % (current_tick, verb, actor, target, amount))
+		if len(combat_log_lines) >= COMBAT_LOG_BATCH:
+			flush_combat_log()
+
+def start_combat_log(path):
+	global combat_log
+	combat_log = open(path, 'w')
+	combat_log.write('tick\tevent\tactor\ttarget\tamount\n')
+
+def flush_combat_log():
+	combat_log.write(''.join(combat_log_lines))
+	del combat_log_lines[:]
+
+def stop_combat_log():
+	global combat_log
+	flush_combat_log()
+	combat_log.close()
+	combat_log = None
 
 
 	
@@ -368,14 +1180,15 @@ def render_bar(x, y, total_width, name, value, maximum, bar_color, back_color):
 def monster_death(monster):
     #transform it into a nasty corpse! it doesn't block, can't be
     #attacked and doesn't move
-	message(monster.name.capitalize() + ' is dead!')
+	log_event('death', monster.name)
+	remove_object(monster)
 	monster.char = '%'
 	monster.color = libtcod.dark_red
 	monster.blocks = False
 	monster.fighter = None
 	monster.ai = None
 	monster.name = 'remains of ' + monster.name
-	monster.send_to_back()
+	add_corpse(monster)
 
 def player_move_or_attack(dx, dy):
 	global fov_recompute
@@ -390,11 +1203,7 @@ def player_move_or_attack(dx, dy):
 	y = player.y + dy
  
     #try to find an attackable object there
-	target = None
-	for object in objects:
-		if object.fighter and object.x == x and object.y == y:
-			target = object
-			break
+	target = fighter_at(x, y)
  
     #attack if target found, move otherwise
 	if target is not None:
@@ -402,60 +1211,212 @@ def player_move_or_attack(dx, dy):
 	else:
 		player.move(dx, dy)
 		fov_recompute = True
+		follow_player()
+
+
+def make_nav_map():
+	#create the long-lived navigation map used by move_astar, once per level. the tiles are copied from
+	#fov_map in one call, which must be up to date
+	global nav_map, nav_path, chase_field_origin
+	nav_map = libtcod.map_new(map.width, map.height)
+	libtcod.map_copy(fov_map, nav_map)
+
+	#objects that block are navigated around, just like walls
+	for obj in objects:
+		if obj.blocks:
+			nav_set_blocked(obj.x, obj.y, True)
+
+	#allocate the A* path once; it is recomputed in place for every query
+	nav_path = libtcod.path_new_using_map(nav_map, 1.41)
+
+	#the chase field depends on the map tiles, so it must be computed again for the new map
+	chase_field_origin = None
+
+def update_chase_field():
+	#compute the distances from the player to all the tiles within CHASE_FIELD_RADIUS, with a flood fill that
+	#ignores objects. it only depends on the map and the player's position, so it is only redone when the player moved
+	global chase_field, chase_field_origin
+	origin = (player.x, player.y)
+	if origin == chase_field_origin:
+		return
+	chase_field_origin = origin
+
+	chase_field = {origin: 0}
+	frontier = [(0, origin)]
+	while frontier:
+		(dist, (x, y)) = heapq.heappop(frontier)
+		if dist > chase_field[(x, y)]:
+			continue  #already reached by a shorter way
+		for (dx, dy, cost) in NEIGHBOUR_STEPS:
+			(nx, ny) = (x + dx, y + dy)
+			new_dist = dist + cost
+			if new_dist > CHASE_FIELD_RADIUS or not (0 <= nx < map.width and 0 <= ny < map.height):
+				continue
+			if map.blocked[nx * map.height + ny] or new_dist >= chase_field.get((nx, ny), new_dist + 1):
+				continue
+			chase_field[(nx, ny)] = new_dist
+			heapq.heappush(frontier, (new_dist, (nx, ny)))
+
+def nav_set_blocked(x, y, blocked):
+	#mark a tile as occupied by a blocking object, or restore it to the state of the map tile
+	i = x * map.height + y
+	if blocked:
+		libtcod.map_set_properties(nav_map, x, y, not map.block_sight[i], False)
+	else:
+		libtcod.map_set_properties(nav_map, x, y, not map.block_sight[i], not map.blocked[i])
+
+def index_object(obj):
+	#add an object to the occupancy index, on top of whatever is already on its tile
+	object_index.setdefault((obj.x, obj.y), []).append(obj)
+	if obj.fighter:
+		bucket_fighter(obj)
+
+def unindex_object(obj):
+	#remove an object from the occupancy index
+	here = object_index[(obj.x, obj.y)]
+	here.remove(obj)
+	if not here:
+		del object_index[(obj.x, obj.y)]
+	if obj.fighter:
+		unbucket_fighter(obj)
+
+def bucket_fighter(obj):
+	#add a fighter to the neighbour buckets
+	bucket = (obj.x / NEIGHBOUR_BUCKET_SIZE, obj.y / NEIGHBOUR_BUCKET_SIZE)
+	fighter_buckets.setdefault(bucket, []).append(obj)
+
+def unbucket_fighter(obj):
+	#remove a fighter from the neighbour buckets
+	bucket = (obj.x / NEIGHBOUR_BUCKET_SIZE, obj.y / NEIGHBOUR_BUCKET_SIZE)
+	fighter_buckets[bucket].remove(obj)
+	if not fighter_buckets[bucket]:
+		del fighter_buckets[bucket]
+
+def closest_fighter(monster, max_range):
+	#return the closest fighter that is neither the monster nor the player, strictly within max_range, or None.
+	#buckets are searched in rings around the monster's own bucket, stopping once no ring can hold anything
+	#closer; ties go to the fighter created first (the lowest slot), which is the first one a scan of the objects
+	#list would find. positions are read straight from the entity arrays
+	xs = entities.x
+	ys = entities.y
+	(mx, my) = (xs[monster.slot], ys[monster.slot])
+	bx = mx / NEIGHBOUR_BUCKET_SIZE
+	by = my / NEIGHBOUR_BUCKET_SIZE
+	closest = None
+	closest_dist = max_range ** 2  #squared distances, no need for sqrt to compare them
+	last_ring = max(map.width, map.height) / NEIGHBOUR_BUCKET_SIZE
+	for ring in range(last_ring + 1):
+		if ring > 0:
+			#no tile in this ring can be closer than this
+			nearest = (ring - 1) * NEIGHBOUR_BUCKET_SIZE + 1
+			if nearest ** 2 > closest_dist or (closest is None and nearest >= max_range):
+				break
 
+		if ring == 0:
+			buckets = [(bx, by)]
+		else:
+			buckets = [(x, y) for x in range(bx - ring, bx + ring + 1) for y in (by - ring, by + ring)]
+			buckets += [(x, y) for x in (bx - ring, bx + ring) for y in range(by - ring + 1, by + ring)]
+
+		for bucket in buckets:
+			for obj in fighter_buckets.get(bucket, ()):
+				if obj == monster or obj == player:
+					continue
+				slot = obj.slot
+				dist = (xs[slot] - mx) ** 2 + (ys[slot] - my) ** 2
+				if dist < closest_dist or (dist == closest_dist and closest is not None and slot < closest.slot):
+					closest = obj
+					closest_dist = dist
+
+	return closest
+
+def objects_at(x, y):
+	#return all the actors on a tile, in drawing order
+	return object_index.get((x, y), [])
+
+def corpses_at(x, y):
+	#return all the corpses on a tile, in drawing order
+	return corpse_index.get((x, y), [])
+
+def fighter_at(x, y):
+	#return the first object on a tile that can fight, or None
+	for obj in objects_at(x, y):
+		if obj.fighter:
+			return obj
+	return None
+
+def check_object_index():
+	#debug check: the occupancy indexes must hold exactly the objects of the layers, at their positions
+	expected = {}
+	expected_corpses = {}
+	expected_buckets = {}
+	for obj in objects:
+		expected.setdefault((obj.x, obj.y), []).append(obj)
+		if obj.fighter:
+			bucket = (obj.x / NEIGHBOUR_BUCKET_SIZE, obj.y / NEIGHBOUR_BUCKET_SIZE)
+			expected_buckets.setdefault(bucket, set()).add(obj)
+	for obj in corpses:
+		expected_corpses.setdefault((obj.x, obj.y), []).append(obj)
+	assert expected == object_index, 'occupancy index out of sync with the objects list'
+	assert expected_corpses == corpse_index, 'corpse index out of sync with the corpses list'
+	assert expected_buckets == dict((bucket, set(objs)) for (bucket, objs) in fighter_buckets.items()), \
+		'neighbour buckets out of sync with the objects list'
 
 def is_blocked(x, y):
     #first test the map tile
-	if map[x][y].blocked:
+	if map.blocked[x * map.height + y]:
 		return True
  
     #now check for any blocking objects
-	for object in objects:
-		if object.blocks and object.x == x and object.y == y:
+	for object in objects_at(x, y):
+		if object.blocks:
 			return True
  
  	return False
 
-def create_room(room):
-    global map
-    #go through the tiles in the rectangle and make them passable
-    for x in range(room.x1 + 1, room.x2):
-        for y in range(room.y1 + 1, room.y2):
-            map[x][y].blocked = False
-            map[x][y].block_sight = False
+def create_room(tiles, room):
+    #make the tiles inside the rectangle passable
+    tiles.carve(room.x1 + 1, room.y1 + 1, room.x2, room.y2)
 
-def place_objects(room):
+def place_objects(level, room, rng):
     #choose random number of monsters
-	num_monsters = libtcod.random_get_int(0, 0, MAX_ROOM_MONSTERS)
+	num_monsters = libtcod.random_get_int(rng, 0, MAX_ROOM_MONSTERS)
  
 	for i in range(num_monsters):
         #choose random spot for this monster
-		x = libtcod.random_get_int(0, room.x1+1, room.x2-1)
-		y = libtcod.random_get_int(0, room.y1+1, room.y2-1)
-		if not is_blocked(x, y):
-			if libtcod.random_get_int(0, 0, 100) < 80:  #80% chance of getting an orc
-            #create an orc
-				fighter_component = Fighter(hp=10, defense=0, power=3, death_function=monster_death)
-				ai_component = BasicMonster()            
-				monster = Object(x, y, 'o', 'orc', libtcod.desaturated_green, blocks=True, fighter=fighter_component, ai=ai_component)
+		x = libtcod.random_get_int(rng, room.x1+1, room.x2-1)
+		y = libtcod.random_get_int(rng, room.y1+1, room.y2-1)
+		if not level.is_blocked(x, y):
+			if libtcod.random_get_int(rng, 0, 100) < 80:  #80% chance of getting an orc
+				level.add_monster('orc', x, y)
 			else:
-            #create a troll
-				fighter_component = Fighter(hp=16, defense=1, power=4, death_function=monster_death)
-				ai_component = BasicMonster()
-
-				monster = Object(x, y, 'T', 'troll', libtcod.darker_green, blocks=True, fighter=fighter_component, ai=ai_component)
- 
-			objects.append(monster)
+				level.add_monster('troll', x, y)
+
+def make_monster(kind, x, y):
+	#create a monster of the given kind, as placed by place_objects
+	(hp, defense, power) = MONSTER_STATS[kind]
+	if kind == 'orc':
+        #create an orc
+		fighter_component = Fighter(hp=hp, defense=defense, power=power, death_function=monster_death)
+		ai_component = BasicMonster()            
+		monster = Object(x, y, 'o', 'orc', libtcod.desaturated_green, blocks=True, fighter=fighter_component, ai=ai_component)
+	else:
+        #create a troll
+		fighter_component = Fighter(hp=hp, defense=defense, power=power, death_function=monster_death)
+		ai_component = BasicMonster()
+		monster = Object(x, y, 'T', 'troll', libtcod.darker_green, blocks=True, fighter=fighter_component, ai=ai_component)
+	entities.speed[monster.slot] = MONSTER_SPEEDS[kind]
+	return monster
 
 def get_names_under_mouse():
 	global mouse
  
     #return a string with the names of all objects under the mouse
-	(x, y) = (mouse.cx, mouse.cy)
+	(x, y) = (camera_x + mouse.cx, camera_y + mouse.cy)
 
 	#create a list with the names of all objects at the mouse's coordinates and in FOV
-	names = [obj.name for obj in objects
-		if obj.x == x and obj.y == y and libtcod.map_is_in_fov(fov_map, obj.x, obj.y)]	
+	names = [obj.name for obj in corpses_at(x, y) + objects_at(x, y)
+		if in_fov(obj.x, obj.y)]	
 
 	names = ', '.join(names)  #join the names, separated by commas
 	return names.capitalize()
@@ -467,13 +1428,18 @@ def handle_keys():
 	global player
 
 	#key = libtcod.console_wait_for_keypress(True)
-	if key.vk == libtcod.KEY_ENTER and key.lalt:
+	if key.vk == libtcod.KEY_ENTER and key.lalt and not headless:
         #Alt+Enter: toggle fullscreen
 		libtcod.console_set_fullscreen(not libtcod.console_is_fullscreen())
+		libtcod.console_flush()  #show the screen again now, render_all may have nothing new to draw
  
 	elif key.vk == libtcod.KEY_ESCAPE:
 		return 'exit'  #exit game
 
+	elif key.vk == libtcod.KEY_F3:
+		toggle_profiling()
+		return 'didnt-take-turn'
+
 	if game_state == 'playing':
         #movement keys
     #movement keys
@@ -500,47 +1466,48 @@ def handle_keys():
 		else:
 			return 'didnt-take-turn'				
 
-def make_map():
-	global map
- 
+def make_map(seed, width=None, height=None, max_rooms=None):
+	#generate the level for a seed, of MAP_WIDTH x MAP_HEIGHT tiles with up to MAX_ROOMS rooms unless told
+	#otherwise. all the randomness comes from an RNG made from the seed and no global state is touched, so
+	#the same seed always gives the same level, in whichever process it is built
+	(width, height, max_rooms) = (width or MAP_WIDTH, height or MAP_HEIGHT, max_rooms or MAX_ROOMS)
+	rng = libtcod.random_new_from_seed(seed)
+
     #fill map with "blocked" tiles
-	map = [[ Tile(True)
-		for y in range(MAP_HEIGHT) ]
-			for x in range(MAP_WIDTH) ]
- 
-    #create two rooms
-	rooms = []
+	level = Level(seed, TileMap(width, height))
+	rooms = level.rooms
 	num_rooms = 0
+	grid = RoomGrid()
+	if ROOM_SAMPLE_FREE_SPACE:
+		free_cells = FreeCells(rng, width, height)
  
- 	for r in range(MAX_ROOMS):
+ 	for r in range(max_rooms):
         #random width and height
-		w = libtcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
-		h = libtcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
-        #random position without going out of the boundaries of the map
-		x = libtcod.random_get_int(0, 0, MAP_WIDTH - w - 1)
-		y = libtcod.random_get_int(0, 0, MAP_HEIGHT - h - 1)
-
-		new_room = Rect(x, y, w, h)
- 
-        #run through the other rooms and see if they intersect with this one
-		failed = False
-		for other_room in rooms:
-			if new_room.intersect(other_room):
-				failed = True
-				break
-		if not failed:
+		w = libtcod.random_get_int(rng, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
+		h = libtcod.random_get_int(rng, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
+		if ROOM_SAMPLE_FREE_SPACE:
+			new_room = free_cells.room(w, h)
+			if new_room is None:
+				break  #the map is full
+		else:
+            #random position without going out of the boundaries of the map
+			x = libtcod.random_get_int(rng, 0, width - w - 1)
+			y = libtcod.random_get_int(rng, 0, height - h - 1)
+			new_room = Rect(x, y, w, h)
+ 
+        #see if the other rooms around intersect with this one
+		if not grid.intersect(new_room):
             #this means there are no intersections, so this room is valid
  
             #"paint" it to the map's tiles
-			create_room(new_room)
+			create_room(level.tiles, new_room)
  
             #center coordinates of new room, will be useful later
 			(new_x, new_y) = new_room.center()
  
 			if num_rooms == 0:
                 #this is the first room, where the player starts at
-				player.x = new_x
-				player.y = new_y
+				level.start = (new_x, new_y)
 			else:
                 #all rooms after the first:
                 #connect it to the previous room with a tunnel
@@ -549,75 +1516,761 @@ def make_map():
 				(prev_x, prev_y) = rooms[num_rooms-1].center()
  
                 #draw a coin (random number that is either 0 or 1)
-				if libtcod.random_get_int(0, 0, 1) == 1:
+				if libtcod.random_get_int(rng, 0, 1) == 1:
                     #first move horizontally, then vertically
-					create_h_tunnel(prev_x, new_x, prev_y)
-					create_v_tunnel(prev_y, new_y, new_x)
+					create_h_tunnel(level.tiles, prev_x, new_x, prev_y)
+					create_v_tunnel(level.tiles, prev_y, new_y, new_x)
+					corner = (new_x, prev_y)
 				else:
                     #first move vertically, then horizontally
-					create_v_tunnel(prev_y, new_y, prev_x)
-					create_h_tunnel(prev_x, new_x, new_y)
+					create_v_tunnel(level.tiles, prev_y, new_y, prev_x)
+					create_h_tunnel(level.tiles, prev_x, new_x, new_y)
+					corner = (prev_x, new_y)
+				level.links.append((num_rooms - 1, num_rooms, corner))
  
 			#add some contents to this room, such as monsters
-			place_objects(new_room)
+			place_objects(level, new_room, rng)
 
             #finally, append the new room to the list
 			rooms.append(new_room)
+			grid.add(new_room)
 			num_rooms += 1
 
+	libtcod.random_delete(rng)
+	return level
 
-def create_h_tunnel(x1, x2, y):
-    global map
-    for x in range(min(x1, x2), max(x1, x2) + 1):
-        map[x][y].blocked = False
-        map[x][y].block_sight = False
 
+def create_h_tunnel(tiles, x1, x2, y):
+    tiles.carve(min(x1, x2), y, max(x1, x2) + 1, y + 1)
 
-def create_v_tunnel(y1, y2, x):
-    global map
+
+def create_v_tunnel(tiles, y1, y2, x):
     #vertical tunnel
-    for y in range(min(y1, y2), max(y1, y2) + 1):
-        map[x][y].blocked = False
-        map[x][y].block_sight = False        	
- 
-def render_all():
-	global color_light_wall
-	global color_light_ground
-	global fov_recompute	
-
-	if fov_recompute:
-        #recompute FOV if needed (the player moved or something)
-		fov_recompute = False
-		libtcod.map_compute_fov(fov_map, player.x, player.y, TORCH_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)    
- 
-    #go through all tiles, and set their background color
-	for y in range(MAP_HEIGHT):
-		for x in range(MAP_WIDTH):
-			visible = libtcod.map_is_in_fov(fov_map, x, y)        	
-			wall = map[x][y].block_sight            
-			if not visible:
-				if wall:
-					libtcod.console_set_char_background(con, x, y, color_dark_wall, libtcod.BKGND_SET )
-				else:
-					libtcod.console_set_char_background(con, x, y, color_dark_ground, libtcod.BKGND_SET )
-			else:
- 				#it's visible
-				if wall:
-					libtcod.console_set_char_background(con, x, y, color_light_wall, libtcod.BKGND_SET )
+    tiles.carve(x, min(y1, y2), x + 1, max(y1, y2) + 1)
+
+def level_to_data(level):
+	#turn a level into plain python data, for the level cache and for sending it between processes
+	tiles = level.tiles
+	rooms = [(room.x1, room.y1, room.x2, room.y2) for room in level.rooms]
+	return (level.seed, tiles.width, tiles.height, bytes(tiles.blocked), bytes(tiles.block_sight),
+		rooms, level.links, level.start, level.monsters)
+
+def level_from_data(data):
+	#the opposite of level_to_data
+	(seed, width, height, blocked, block_sight, rooms, links, start, monsters) = data
+	tiles = TileMap(width, height)
+	tiles.blocked = bytearray(blocked)
+	tiles.block_sight = bytearray(block_sight)
+	level = Level(seed, tiles)
+	level.rooms = [Rect(x1, y1, x2 - x1, y2 - y1) for (x1, y1, x2, y2) in rooms]
+	level.links = links
+	level.start = start
+	for (kind, x, y) in monsters:
+		level.add_monster(kind, x, y)
+	return level
+
+def level_cache_path(seed):
+	#the file of a level in the cache, which depends on everything that changes what make_map generates
+	params = (LEVEL_FORMAT, MAP_WIDTH, MAP_HEIGHT, ROOM_MIN_SIZE, ROOM_MAX_SIZE, MAX_ROOMS, MAX_ROOM_MONSTERS,
+		ROOM_SAMPLE_FREE_SPACE)
+	key = hashlib.sha1(repr(params).encode('ascii')).hexdigest()[:16]
+	return os.path.join(LEVEL_CACHE_DIR, 'level-%d-%s.pickle' % (seed, key))
+
+def build_level(seed):
+	#return the data of the level for a seed, read from the level cache if it is there, or generated and
+	#written to the cache otherwise. this is what the background workers run
+	path = level_cache_path(seed)
+	try:
+		with open(path, 'rb') as f:
+			return pickle.load(f)
+	except (IOError, OSError, EOFError, pickle.UnpicklingError):
+		pass  #not cached yet (or a broken file, which is replaced below)
+
+	data = level_to_data(make_map(seed))
+	try:
+		if not os.path.isdir(LEVEL_CACHE_DIR):
+			os.makedirs(LEVEL_CACHE_DIR)
+		#write to a temporary file first, so no other process ever reads a half written level
+		temp_path = '%s.%d.tmp' % (path, os.getpid())
+		with open(temp_path, 'wb') as f:
+			pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+		os.rename(temp_path, path)
+	except (IOError, OSError):
+		pass  #the cache is only an optimization
+	return data
+
+def prefetch_levels(seeds):
+	#start generating the levels for the given seeds in the background worker processes, for get_level to
+	#pick up. the game has no way to the next level yet, so nothing starts them
+	global level_pool
+	if level_pool is None:
+		level_pool = multiprocessing.Pool(LEVEL_WORKERS)
+	for seed in seeds:
+		if seed not in pending_levels:
+			pending_levels[seed] = level_pool.apply_async(build_level, (seed,))
+
+def stop_level_pool():
+	#stop the background worker processes, if they were started, and forget the levels they were building
+	global level_pool
+	if level_pool is not None:
+		level_pool.terminate()
+		level_pool.join()
+		level_pool = None
+	pending_levels.clear()
+
+def get_level(seed):
+	#return the level for a seed: the one generated in the background if there is one, otherwise build it now
+	if seed in pending_levels:
+		return level_from_data(pending_levels.pop(seed).get())
+	return level_from_data(build_level(seed))
+
+def load_level(level, kept=(), shift=None):
+	#make a level the current one: create its objects, with the player at the start, and the
+	#occupancy index, FOV and navigation maps that go with it. when a world window moves, shift is how far
+	#the map coordinates moved, and the objects in kept stay as they are, with their turns on the schedule and
+	#the player's FOV moved with them
+	global map, objects, corpses, object_index, corpse_index, fighter_buckets, current_tick, level_seed, room_graph
+	global fov_origin, fov_box, fov_bits
+	level_seed = level.seed
+	map = level.tiles
+	room_graph = None
+	if level.rooms:
+		room_graph = RoomGraph(map.width, map.height, level.rooms, level.links)
+
+	#the objects of the last level are gone, only the player's data is kept, and the kept objects in their slot
+	#order, so the ones due at the same tick still act in the same order
+	kept_corpses = [obj for obj in kept if obj in corpses]
+	kept_actors = [obj for obj in kept if obj not in corpses]
+	kept = set(kept)
+	turns = [(tick, entities.objects[slot]) for (tick, slot) in schedule if entities.objects[slot] in kept]
+	entities.compact([player] + sorted(kept, key=lambda obj: obj.slot))
+	schedule[:] = [(tick, obj.slot) for (tick, obj) in turns]
+	heapq.heapify(schedule)
+	if shift is None:
+		current_tick = 0
+
+	#start with an empty occupancy index, objects are added as they are placed
+	object_index = {}
+	corpse_index = {}
+	fighter_buckets = {}
+	corpses = Layer()
+
+	(player.x, player.y) = level.start
+	objects = Layer([player])
+	index_object(player)
+	if shift is not None:
+		(dx, dy) = shift
+		for obj in kept:
+			(obj.x, obj.y) = (obj.x + dx, obj.y + dy)
+			entities.last_x[obj.slot] += dx
+			entities.last_y[obj.slot] += dy
+	for obj in kept_actors:
+		objects.append(obj)
+		index_object(obj)
+	for obj in kept_corpses:
+		add_corpse(obj)
+	for (kind, x, y) in level.monsters:
+		monster = make_monster(kind, x, y)
+		objects.append(monster)
+		index_object(monster)
+
+	if shift is None:
+		make_level_maps()
+	else:
+		#the monsters still see the player as they did before the window moved, until update_fov
+		(old_origin, old_box, old_bits) = (fov_origin, fov_box, fov_bits)
+		make_level_maps()
+		if old_origin is not None:
+			(x1, y1, x2, y2) = old_box
+			fov_origin = (old_origin[0] + dx, old_origin[1] + dy)
+			fov_box = (x1 + dx, y1 + dy, x2 + dx, y2 + dy)
+			fov_bits = old_bits
+
+def make_level_maps():
+	#create the FOV and navigation maps of the current map and objects, each in one pass over the tiles
+	global fov_map, fov_recompute, fov_origin, fov_box, fov_bits
+	fov_map = libtcod.map_new(map.width, map.height)
+	map.load_into(fov_map)
+
+	#the remembered FOVs are for the old map. nothing is in FOV until update_fov
+	fov_cache.clear()
+	fov_origin = None
+	fov_box = (0, 0, 0, 0)
+	fov_bits = bytearray()
+
+	make_nav_map()
+
+	fov_recompute = True
+
+def add_object(obj):
+	#put a new object on the current level: in the objects list, the occupancy index and the navigation map.
+	#objects that neither fight nor block go to the corpses
+	if not obj.fighter and not obj.blocks:
+		add_corpse(obj)
+		return
+	objects.append(obj)
+	index_object(obj)
+	if obj.blocks:
+		nav_set_blocked(obj.x, obj.y, True)
+
+def remove_object(obj):
+	#the opposite of add_object, for an actor
+	objects.remove(obj)
+	unindex_object(obj)
+	if obj.blocks:
+		nav_set_blocked(obj.x, obj.y, False)
+
+def add_corpse(obj):
+	#put an object on the corpses layer, drawn below the actors, which nothing else in the game looks at
+	corpses.append(obj)
+	corpse_index.setdefault((obj.x, obj.y), []).append(obj)
+
+def chunk_seed(seed, cx, cy, what):
+	#a number made from the world seed, a chunk position and what it is for, the same in every run
+	digest = hashlib.sha1(repr((seed, cx, cy, what)).encode('ascii')).hexdigest()
+	return int(digest[:8], 16)
+
+def chunk_door(seed, cx, cy, side):
+	#where the tunnel between a chunk and its neighbour on the 'east' or 'south' side crosses the edge.
+	#both chunks get the same answer, so their tunnels meet
+	return 1 + chunk_seed(seed, cx, cy, side) % (CHUNK_SIZE - 2)
+
+def make_chunk(seed, cx, cy):
+	#generate a chunk of the world: rooms and monsters as in a level, and tunnels from its first room to
+	#a door on each of its edges
+	level = make_map(chunk_seed(seed, cx, cy, 'rooms'), CHUNK_SIZE, CHUNK_SIZE, CHUNK_ROOMS)
+	tiles = level.tiles
+	(x, y) = level.start
+	last = CHUNK_SIZE - 1
+	for (door_y, edge_x) in [(chunk_door(seed, cx - 1, cy, 'east'), 0), (chunk_door(seed, cx, cy, 'east'), last)]:
+		create_v_tunnel(tiles, y, door_y, x)
+		create_h_tunnel(tiles, x, edge_x, door_y)
+	for (door_x, edge_y) in [(chunk_door(seed, cx, cy - 1, 'south'), 0), (chunk_door(seed, cx, cy, 'south'), last)]:
+		create_h_tunnel(tiles, x, door_x, y)
+		create_v_tunnel(tiles, y, edge_y, door_x)
+	return Chunk(tiles, level.start, [(kind, mx, my, None) for (kind, mx, my) in level.monsters])
+
+def object_record(obj, x0, y0):
+	#the data needed to make a monster or remains again later: (name, x, y, hp) with the position relative
+	#to (x0, y0), and an hp of 0 for remains
+	hp = obj.fighter.hp if obj.fighter else 0
+	return (obj.name, obj.x - x0, obj.y - y0, hp)
+
+def object_from_record(record, x0, y0):
+	#the opposite of object_record. an hp of None is a monster that was never hurt
+	(name, x, y, hp) = record
+	if hp == 0:
+		return Object(x0 + x, y0 + y, '%', name, libtcod.dark_red, blocks=False)
+	monster = make_monster(name, x0 + x, y0 + y)
+	if hp is not None:
+		monster.fighter.hp = hp
+	return monster
+
+def chunk_path(cx, cy):
+	return os.path.join(CHUNK_DIR, str(level_seed), '%d,%d.chunk' % (cx, cy))
+
+def save_chunk(cx, cy, chunk):
+	#write a chunk that is dropped from memory: its tiles compressed (they are mostly long runs of walls)
+	#and its object records
+	tiles = zlib.compress(bytes(chunk.tiles.blocked) + bytes(chunk.tiles.block_sight))
+	path = chunk_path(cx, cy)
+	if not os.path.isdir(os.path.dirname(path)):
+		os.makedirs(os.path.dirname(path))
+	with open(path, 'wb') as f:
+		pickle.dump((CHUNK_FORMAT, tiles, chunk.start, chunk.records), f, pickle.HIGHEST_PROTOCOL)
+
+def load_chunk(cx, cy):
+	#read a chunk written by save_chunk, or return None if it never was
+	try:
+		with open(chunk_path(cx, cy), 'rb') as f:
+			(version, tiles, start, records) = pickle.load(f)
+	except (IOError, OSError):
+		return None
+	if version != CHUNK_FORMAT:
+		return None
+	tiles = zlib.decompress(tiles)
+	size = CHUNK_SIZE * CHUNK_SIZE
+	chunk_tiles = TileMap(CHUNK_SIZE, CHUNK_SIZE)
+	chunk_tiles.blocked = bytearray(tiles[:size])
+	chunk_tiles.block_sight = bytearray(tiles[size:])
+	return Chunk(chunk_tiles, start, records)
+
+def get_chunk(cx, cy):
+	#take a chunk out of memory, or read it from disk, or generate it if the player never came near it
+	chunk = chunk_cache.pop((cx, cy), None)
+	if chunk is None:
+		chunk = load_chunk(cx, cy)
+	if chunk is None:
+		chunk = make_chunk(level_seed, cx, cy)
+	return chunk
+
+def put_chunk(cx, cy, chunk):
+	#keep a chunk that is not played on anymore in memory, writing the least recently used ones to disk
+	chunk_cache[(cx, cy)] = chunk
+	while len(chunk_cache) > CHUNK_CACHE_SIZE:
+		((old_cx, old_cy), old_chunk) = chunk_cache.popitem(last=False)
+		save_chunk(old_cx, old_cy, old_chunk)
+
+def load_window(ox, oy, player_x, player_y):
+	#play on the chunks of the window with chunk (ox, oy) at its top left, with the player at the given world
+	#position, and the map coordinates starting at its top left corner. the objects that are still in the window
+	#stay as they are; the others go back to the cache with the chunks of the last window that are not in it
+	global world_origin, window_chunks
+	size = WINDOW_CHUNKS * CHUNK_SIZE
+	level = Level(level_seed, TileMap(size, size))
+	level.start = (player_x - ox * CHUNK_SIZE, player_y - oy * CHUNK_SIZE)
+
+	(kept, shift) = ([], None)
+	if world_origin is not None:
+		(old_ox, old_oy) = world_origin
+		shift = ((old_ox - ox) * CHUNK_SIZE, (old_oy - oy) * CHUNK_SIZE)
+		for chunk in window_chunks.values():
+			chunk.records = []
+		for obj in itertools.chain(corpses, objects):
+			if obj != player:
+				(cx, cy) = (old_ox + obj.x / CHUNK_SIZE, old_oy + obj.y / CHUNK_SIZE)
+				if ox <= cx < ox + WINDOW_CHUNKS and oy <= cy < oy + WINDOW_CHUNKS:
+					kept.append(obj)
 				else:
-					libtcod.console_set_char_background(con, x, y, color_light_ground, libtcod.BKGND_SET )					 
-    #draw all objects in the list
-	for object in objects:
-		object.clear()
-
-	for object in objects:
-		if object != player:		
-			object.draw()
-	player.draw()
-
-    #blit the contents of "con" to the root console
-	libtcod.console_blit(con, 0, 0, SCREEN_WIDTH, SCREEN_HEIGHT, 0, 0, 0)
+					window_chunks[(cx, cy)].records.append(
+						object_record(obj, (cx - old_ox) * CHUNK_SIZE, (cy - old_oy) * CHUNK_SIZE))
+		for ((cx, cy), chunk) in window_chunks.items():
+			if not (ox <= cx < ox + WINDOW_CHUNKS and oy <= cy < oy + WINDOW_CHUNKS):
+				put_chunk(cx, cy, chunk)
+
+	#the chunks that stay in the window have no records, their objects are kept
+	old_chunks = window_chunks
+	window_chunks = {}
+	for i in range(WINDOW_CHUNKS):
+		for j in range(WINDOW_CHUNKS):
+			chunk = old_chunks.get((ox + i, oy + j))
+			if chunk is None:
+				chunk = get_chunk(ox + i, oy + j)
+			level.tiles.paste(chunk.tiles, i * CHUNK_SIZE, j * CHUNK_SIZE)
+			window_chunks[(ox + i, oy + j)] = chunk
+	load_level(level, kept, shift)
+	for ((cx, cy), chunk) in window_chunks.items():
+		for record in chunk.records:
+			add_object(object_from_record(record, (cx - ox) * CHUNK_SIZE, (cy - oy) * CHUNK_SIZE))
+	world_origin = (ox, oy)
+
+def start_world(seed):
+	#start a world from a seed, with the player in the first room of chunk (0, 0), in the middle of the window.
+	#the chunks written by an older game from the same seed are gone
+	global level_seed, world_origin, window_chunks
+	level_seed = seed
+	world_origin = None
+	window_chunks = {}
+	chunk_cache.clear()
+	shutil.rmtree(os.path.join(CHUNK_DIR, str(seed)), ignore_errors=True)
+	(x, y) = make_chunk(seed, 0, 0).start
+	load_window(-(WINDOW_CHUNKS / 2), -(WINDOW_CHUNKS / 2), x, y)
+
+def follow_player():
+	#in a world, move the window when the player left its middle chunk, so the player is in the middle again.
+	#the camera moves with it, so the screen still shows the same part of the world
+	global camera_x, camera_y, lit_box
+	if world_origin is None:
+		return
+	(old_ox, old_oy) = world_origin
+	(x, y) = (old_ox * CHUNK_SIZE + player.x, old_oy * CHUNK_SIZE + player.y)
+	(ox, oy) = (x / CHUNK_SIZE - WINDOW_CHUNKS / 2, y / CHUNK_SIZE - WINDOW_CHUNKS / 2)
+	if (ox, oy) == (old_ox, old_oy):
+		return
+	load_window(ox, oy, x, y)
+	(dx, dy) = ((old_ox - ox) * CHUNK_SIZE, (old_oy - oy) * CHUNK_SIZE)
+	(camera_x, camera_y) = (camera_x + dx, camera_y + dy)
+	(x1, y1, x2, y2) = lit_box
+	lit_box = (x1 + dx, y1 + dy, x2 + dx, y2 + dy)
+
+def ints_to_bytes(values):
+	#the bytes of an array of ints, little endian whatever the machine is
+	if sys.byteorder == 'big':
+		values = array.array('i', values)
+		values.byteswap()
+	return values.tostring()
+
+def ints_from_bytes(data):
+	#the opposite of ints_to_bytes
+	values = array.array('i')
+	values.fromstring(data)
+	if sys.byteorder == 'big':
+		values.byteswap()
+	return values
+
+def chunk_to_data(cx, cy, chunk):
+	return (cx, cy, chunk.start, chunk.records, bytes(chunk.tiles.blocked), bytes(chunk.tiles.block_sight))
+
+def chunk_from_data(data):
+	(cx, cy, start, records, blocked, block_sight) = data
+	tiles = TileMap(CHUNK_SIZE, CHUNK_SIZE)
+	tiles.blocked = bytearray(blocked)
+	tiles.block_sight = bytearray(block_sight)
+	return ((cx, cy), Chunk(tiles, start, records))
+
+def save_game(path):
+	#write a snapshot of the whole game. after the SAVE_HEADER come the tile arrays and the entity arrays as
+	#they are in memory, then the flags, death function, glyph and color of every entity packed in bytes, then
+	#the rest of the state pickled. a snapshot of a world only has the chunks in memory, the ones written
+	#to CHUNK_DIR stay there
+	n = len(entities.objects)
+	death_functions = [None, player_death, monster_death]
+	flags = bytearray(n)
+	deaths = bytearray(n)
+	chars = bytearray(n)
+	colors = bytearray(3 * n)
+	for (slot, obj) in enumerate(entities.objects):
+		flags[slot] = obj.blocks | bool(obj.fighter) << 1 | bool(obj.mage) << 2 | bool(obj.ai) << 3
+		if obj.fighter:
+			deaths[slot] = death_functions.index(obj.fighter.death_function)
+		chars[slot] = ord(obj.char)
+		colors[3 * slot:3 * slot + 3] = bytearray([obj.color.r, obj.color.g, obj.color.b])
+
+	world = None
+	if world_origin is not None:
+		world = (world_origin, [chunk_to_data(cx, cy, chunk) for ((cx, cy), chunk) in window_chunks.items()],
+			[chunk_to_data(cx, cy, chunk) for ((cx, cy), chunk) in chunk_cache.items()])
+	state = {
+		'names': [obj.name for obj in entities.objects],
+		'objects': [obj.slot for obj in objects],
+		'corpses': [obj.slot for obj in corpses],
+		'player': player.slot,
+		'game_msgs': game_msgs.state(),
+		'game_state': game_state,
+		'turn_counter': turn_counter,
+		'level_seed': level_seed,
+		'schedule': list(schedule),
+		'current_tick': current_tick,
+		'camera': (camera_x, camera_y),
+		'room_graph': room_graph and ([(room.x1, room.y1, room.x2, room.y2) for room in room_graph.rooms],
+			room_graph.links),
+		'rng': game_rng.getstate(),
+		'world': world,
+	}
+
+	#write to a temporary file first, so a snapshot is never left half written
+	temp_path = '%s.%d.tmp' % (path, os.getpid())
+	with open(temp_path, 'wb') as f:
+		f.write(struct.pack(SAVE_HEADER, SAVE_MAGIC, SAVE_FORMAT, map.width, map.height, n, len(EntityStore.FIELDS)))
+		f.write(map.blocked)
+		f.write(map.block_sight)
+		for field in EntityStore.FIELDS:
+			f.write(ints_to_bytes(getattr(entities, field)))
+		for packed in (flags, deaths, chars, colors):
+			f.write(packed)
+		pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+	os.rename(temp_path, path)
+
+def load_game(path):
+	#restore the game from a snapshot written by save_game. the file is mapped into memory and every array is
+	#copied out of it in one piece; only the objects are made again one by one, then the occupancy index and
+	#the FOV and navigation maps are rebuilt from the arrays. nothing is generated again
+	global entities, map, objects, corpses, player, object_index, corpse_index, fighter_buckets, current_tick
+	global level_seed, room_graph
+	global game_msgs, game_state, turn_counter, camera_x, camera_y, world_origin, window_chunks
+	with open(path, 'rb') as f:
+		data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+	try:
+		(magic, version, width, height, n, fields) = struct.unpack_from(SAVE_HEADER, data)
+		if magic != SAVE_MAGIC or version != SAVE_FORMAT or fields != len(EntityStore.FIELDS):
+			raise ValueError('%s is not a snapshot of this version of the game' % path)
+		#tiles, entity fields, then flags, death functions, glyphs and colors
+		sizes = [width * height] * 2 + [4 * n] * fields + [n, n, n, 3 * n]
+		sections = []
+		offset = struct.calcsize(SAVE_HEADER)
+		for size in sizes:
+			sections.append(data[offset:offset + size])
+			offset += size
+		state = pickle.loads(data[offset:])
+	finally:
+		data.close()
+
+	map = TileMap(width, height)
+	map.blocked = bytearray(sections[0])
+	map.block_sight = bytearray(sections[1])
+	columns = [ints_from_bytes(section) for section in sections[2:2 + fields]]
+	(flags, deaths, chars, colors) = [bytearray(section) for section in sections[2 + fields:]]
+
+	#make the objects again in slot order, then put the saved arrays in place of the ones they filled in
+	death_functions = [None, player_death, monster_death]
+	entities = EntityStore()
+	for (slot, name) in enumerate(state['names']):
+		fighter = ai = mage = None
+		if flags[slot] & 2:
+			fighter = Fighter(0, 0, 0, death_functions[deaths[slot]])
+		if flags[slot] & 4:
+			mage = Mage(0)
+		if flags[slot] & 8:
+			ai = BasicMonster()
+		color = libtcod.Color(colors[3 * slot], colors[3 * slot + 1], colors[3 * slot + 2])
+		Object(0, 0, chr(chars[slot]), name, color, blocks=bool(flags[slot] & 1), fighter=fighter, ai=ai, mage=mage)
+	for (field, values) in zip(EntityStore.FIELDS, columns):
+		setattr(entities, field, values)
+
+	player = entities.objects[state['player']]
+	objects = Layer(entities.objects[slot] for slot in state['objects'])
+	object_index = {}
+	fighter_buckets = {}
+	for obj in objects:
+		index_object(obj)
+	corpses = Layer()
+	corpse_index = {}
+	for slot in state['corpses']:
+		add_corpse(entities.objects[slot])
+	del schedule[:]
+	schedule.extend(state['schedule'])
+	current_tick = state['current_tick']
+	level_seed = state['level_seed']
+	make_level_maps()
+
+	world_origin = None
+	window_chunks = {}
+	chunk_cache.clear()
+	if state['world'] is not None:
+		(world_origin, window, cache) = state['world']
+		window_chunks = dict(chunk_from_data(chunk) for chunk in window)
+		chunk_cache.update(chunk_from_data(chunk) for chunk in cache)
+
+	game_msgs = MessageLog((verb, actor, target, amount, count, libtcod.Color(*color))
+		for (verb, actor, target, amount, count, color) in state['game_msgs'])
+	game_state = state['game_state']
+	turn_counter = state['turn_counter']
+	(camera_x, camera_y) = state['camera']
+	game_rng.setstate(state['rng'])
+	room_graph = None
+	if state['room_graph'] is not None:
+		(rooms, links) = state['room_graph']
+		room_graph = RoomGraph(map.width, map.height, [Rect(x1, y1, x2 - x1, y2 - y1) for (x1, y1, x2, y2) in rooms],
+			links)
+	reset_render_cache()
+
+def reset_render_cache():
+	#forget everything that was drawn, so the next render_all paints all tiles, objects and the panel
+	global tile_cache, lit_box, drawn_glyphs, panel_state
+	tile_cache = bytearray([TILE_NOT_DRAWN]) * (CAMERA_WIDTH * CAMERA_HEIGHT)
+	lit_box = camera_box()
+	drawn_glyphs = {}
+	panel_state = None
+
+def camera_box(box=None):
+	#return the part of an area (x1, y1, x2, y2) of the map that the camera shows, or all it shows. on a map
+	#smaller than the camera, that stops at the edges of the map
+	(cx1, cy1, cx2, cy2) = (camera_x, camera_y, min(camera_x + CAMERA_WIDTH, map.width),
+		min(camera_y + CAMERA_HEIGHT, map.height))
+	if box is None:
+		return (cx1, cy1, cx2, cy2)
+	(x1, y1, x2, y2) = box
+	return (max(x1, cx1), max(y1, cy1), min(x2, cx2), min(y2, cy2))
+
+def move_camera():
+	#scroll the camera if the player got too close to its edges, and tell whether it moved.
+	#the tiles all have to be painted again then, so the camera only moves when it has to
+	global camera_x, camera_y, tile_cache, lit_box
+	x = min(max(camera_x, player.x + CAMERA_MARGIN + 1 - CAMERA_WIDTH), player.x - CAMERA_MARGIN)
+	y = min(max(camera_y, player.y + CAMERA_MARGIN + 1 - CAMERA_HEIGHT), player.y - CAMERA_MARGIN)
+	#the camera stays inside the map, and at 0 on the sides where the map is smaller than the camera
+	x = max(0, min(x, map.width - CAMERA_WIDTH))
+	y = max(0, min(y, map.height - CAMERA_HEIGHT))
+	if (x, y) == (camera_x, camera_y):
+		return False
+	(camera_x, camera_y) = (x, y)
+	tile_cache = bytearray([TILE_NOT_DRAWN]) * (CAMERA_WIDTH * CAMERA_HEIGHT)
+	lit_box = camera_box()
+	return True
+
+def torch_box(x, y):
+	#return the area (x1, y1, x2, y2) that the torch can light from the given position
+	if TORCH_RADIUS == 0:  #no limit
+		return (0, 0, map.width, map.height)
+	return (max(0, x - TORCH_RADIUS), max(0, y - TORCH_RADIUS),
+		min(map.width, x + TORCH_RADIUS + 1), min(map.height, y + TORCH_RADIUS + 1))
+
+def render_tiles(box):
+	#set the background color of the tiles in the area whose visible/wall state changed since they were last drawn.
+	#the tile cache is by position on the screen, only the part of the area that the camera shows is drawn
+	(x1, y1, x2, y2) = camera_box(box)
+	h = map.height
+	changed = False
+	for y in range(y1, y2):
+		for x in range(x1, x2):
+			(sx, sy) = (x - camera_x, y - camera_y)
+			i = sx * CAMERA_HEIGHT + sy
+			state = 2 * in_fov(x, y) + map.block_sight[x * h + y]
+			if tile_cache[i] != state:
+				tile_cache[i] = state
+				libtcod.console_set_char_background(con, sx, sy, tile_colors[state], libtcod.BKGND_SET )
+				changed = True
+	return changed
+
+def render_objects():
+	#draw the objects in FOV, with the player on top. only the tiles whose glyph changed are touched.
+	#the glyphs are by position on the screen, so the ones that scrolled away are erased too
+	global drawn_glyphs
+	glyphs = {}
+	(x1, y1, x2, y2) = camera_box(fov_box)
+	for y in range(y1, y2):
+		for x in range(x1, x2):
+			if not in_fov(x, y):
+				continue
+			#corpses first, so the actors on the same tile are drawn over them
+			for object in corpses_at(x, y) + objects_at(x, y):
+				if object != player:
+					glyphs[(x - camera_x, y - camera_y)] = (object.char, object.color)
+	(x, y) = (player.x, player.y)
+	if in_fov(x, y) and x1 <= x < x2 and y1 <= y < y2:
+		glyphs[(x - camera_x, y - camera_y)] = (player.char, player.color)
+
+	changed = False
+	for (x, y) in drawn_glyphs:
+		if (x, y) not in glyphs:
+			#nothing to show there anymore, erase the old character
+			libtcod.console_put_char(con, x, y, ' ', libtcod.BKGND_NONE)
+			changed = True
+	for (x, y), (char, color) in glyphs.items():
+		if drawn_glyphs.get((x, y)) != (char, color):
+			libtcod.console_set_default_foreground(con, color)
+			libtcod.console_put_char(con, x, y, char, libtcod.BKGND_NONE)
+			changed = True
+	drawn_glyphs = glyphs
+	return changed
+
+def update_fov():
+	#recompute FOV if needed (the player moved or something), and tell whether it changed.
+	#the map never changes, so the FOV only depends on the player's position: the FOVs of the last
+	#FOV_CACHE_SIZE positions are remembered as bitsets, and only new positions need map_compute_fov
+	global fov_recompute, fov_origin, fov_box, fov_bits
+	if not fov_recompute:
+		return False
+	fov_recompute = False
+
+	origin = (player.x, player.y)
+	if origin == fov_origin:
+		return False  #an attack or a failed move, the player is still at the same place
+	fov_origin = origin
+
+	if origin in fov_cache:
+		(fov_box, fov_bits) = fov_cache.pop(origin)
+	else:
+		libtcod.map_compute_fov(fov_map, player.x, player.y, TORCH_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)    
 
+		#keep the FOV as one bit per tile of the area that the torch can light
+		fov_box = torch_box(player.x, player.y)
+		(x1, y1, x2, y2) = fov_box
+		fov_bits = bytearray(((x2 - x1) * (y2 - y1) + 7) / 8)
+		i = 0
+		for x in range(x1, x2):
+			for y in range(y1, y2):
+				if libtcod.map_is_in_fov(fov_map, x, y):
+					fov_bits[i >> 3] |= 1 << (i & 7)
+				i += 1
+		if len(fov_cache) >= FOV_CACHE_SIZE:
+			fov_cache.popitem(last=False)  #forget the least recently used one
+
+	fov_cache[origin] = (fov_box, fov_bits)
+	return True
+
+def in_fov(x, y):
+	#tell whether a tile is in the player's FOV
+	(x1, y1, x2, y2) = fov_box
+	if not (x1 <= x < x2 and y1 <= y < y2):
+		return False
+	i = (x - x1) * (y2 - y1) + y - y1
+	return bool(fov_bits[i >> 3] & (1 << (i & 7)))
+
+def toggle_profiling():
+	global profiling
+	profiling = not profiling
+	profile_frame.clear()
+
+def profile_clock():
+	#the start time for profile_lap; costs next to nothing when not profiling
+	if not profiling:
+		return 0
+	return time.time()
+
+def profile_lap(phase, start):
+	#add the time since start to a phase of the current frame, and return the current time to start the next one
+	if not profiling:
+		return 0
+	now = time.time()
+	profile_frame[phase] = profile_frame.get(phase, 0.0) + now - start
+	return now
+
+def profile_end_frame(took_turn):
+	#if a turn was played in this frame, add its phase times to the rolling samples and to the trace file
+	global profile_turns, profile_trace, profile_trace_file
+	if not profiling:
+		return
+	if took_turn:
+		if profile_trace is None:
+			profile_trace_file = open(PROFILE_TRACE_FILE, 'w')
+			profile_trace = csv.writer(profile_trace_file)
+			profile_trace.writerow(['turn', 'objects'] + [phase + '_ms' for phase in PROFILE_PHASES])
+
+		times = [profile_frame.get(phase, 0.0) for phase in PROFILE_PHASES]
+		for (phase, seconds) in zip(PROFILE_PHASES, times):
+			profile_samples[phase].append(seconds)
+		profile_trace.writerow([turn_counter, len(objects)] + ['%.3f' % (seconds * 1000) for seconds in times])
+		#flushed every turn, so the turns before a hang or a kill are in the file
+		profile_trace_file.flush()
+		profile_turns += 1
+	profile_frame.clear()
+
+def close_profile_trace():
+	global profile_trace, profile_trace_file
+	if profile_trace_file is not None:
+		profile_trace_file.close()
+		(profile_trace, profile_trace_file) = (None, None)
+
+def render_profile_overlay():
+	#show the average and p99 of every phase, in milliseconds, at the right of the panel
+	x = SCREEN_WIDTH - 32
+	libtcod.console_set_default_background(panel, libtcod.black)
+	libtcod.console_rect(panel, x, 0, 32, PANEL_HEIGHT, True, libtcod.BKGND_SET)
+	libtcod.console_set_default_foreground(panel, libtcod.yellow)
+	for (y, phase) in enumerate(PROFILE_PHASES):
+		samples = sorted(profile_samples[phase])
+		if samples:
+			average = sum(samples) / len(samples)
+			p99 = samples[int(0.99 * (len(samples) - 1))]
+			line = '%-11s %7.2f %7.2f ms' % (phase, average * 1000, p99 * 1000)
+		else:
+			line = '%-11s       -       - ms' % phase
+		libtcod.console_print_ex(panel, x + 1, y, libtcod.BKGND_NONE, libtcod.LEFT, line)
+
+def render_all(mid_turn=False):
+	#draw what changed since the last call, and tell whether anything was drawn (and needs a console_flush).
+	#mid_turn is for a frame drawn while the monsters of a turn are still playing (see play_monster_turns):
+	#the FOV is not updated then, as the monsters left must see the one from before the player's move
+	global lit_box, panel_state
+
+	con_changed = False
+	start = profile_clock()
+	fov_changed = not mid_turn and update_fov()
+	if fov_changed:
+		start = profile_lap('fov', start)
+
+	if move_camera() or fov_changed:
+		#only the tiles that were lit before, or can be lit now, may have changed (all of them, if the camera moved)
+		con_changed = render_tiles(lit_box)
+		con_changed = render_tiles(fov_box) or con_changed
+		lit_box = fov_box
+		start = profile_lap('tiles', start)
+
+	con_changed = render_objects() or con_changed
+
+    #blit the contents of "con" to the root console (there is none without a window, see play_terminal)
+	if con_changed and not headless:
+		libtcod.console_blit(con, 0, 0, CAMERA_WIDTH, CAMERA_HEIGHT, 0, 0, 0)
+
+	#the GUI panel only needs to be drawn again when something on it changed
+	names = get_names_under_mouse()
+	state = (game_msgs.version, player.fighter.hp, player.fighter.max_hp, player.mage.mp, player.mage.max_mp, names,
+		profiling, profile_turns)
+	if state == panel_state:
+		profile_lap('render', start)
+		return con_changed
+	panel_state = state
 
 	#prepare to render the GUI panel
 	libtcod.console_set_default_background(panel, libtcod.black)
@@ -625,7 +2278,7 @@ def render_all():
 
     #print the game messages, one line at a time
 	y = 1
-	for (line, color) in game_msgs:
+	for (line, color) in game_msgs.lines():
 		libtcod.console_set_default_foreground(panel, color)
 		libtcod.console_print_ex(panel, MSG_X, y, libtcod.BKGND_NONE, libtcod.LEFT, line)
 		y += 1		
@@ -637,69 +2290,650 @@ def render_all():
 
 	#display names of objects under the mouse
 	libtcod.console_set_default_foreground(panel, libtcod.light_gray)
-	libtcod.console_print_ex(panel, 1, 0, libtcod.BKGND_NONE, libtcod.LEFT, get_names_under_mouse())
-
-    #blit the contents of "panel" to the root console
-	libtcod.console_blit(panel, 0, 0, SCREEN_WIDTH, PANEL_HEIGHT, 0, 0, PANEL_Y)
-
-libtcod.console_set_custom_font('arial10x10.png', libtcod.FONT_TYPE_GREYSCALE | libtcod.FONT_LAYOUT_TCOD)
-libtcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT, 'python/libtcod tutorial', False)
-con = libtcod.console_new(SCREEN_WIDTH, SCREEN_HEIGHT)
-libtcod.sys_set_fps(LIMIT_FPS)
-
-fighter_component = Fighter(hp=30, defense=2, power=3, death_function=player_death)
-mage_component = Mage(mp=20)
-player = Object(0, 0, '@', 'player', libtcod.white, blocks=True, fighter=fighter_component, mage=mage_component)
-#player.x = 25
-#player.y = 23
-#npc = Object(SCREEN_WIDTH/2 - 5, SCREEN_HEIGHT/2, '@', libtcod.yellow)
-objects = [player]
-
-make_map()
-
-fov_map = libtcod.map_new(MAP_WIDTH, MAP_HEIGHT)
-for y in range(MAP_HEIGHT):
-    for x in range(MAP_WIDTH):
-        libtcod.map_set_properties(fov_map, x, y, not map[x][y].block_sight, not map[x][y].blocked)
-
-fov_recompute = True
-
-panel = libtcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
-
-message('Welcome stranger! Prepare to perish in the Tombs of the Ancient Kings.', libtcod.white)
-message('Press Backspace or Del to hurl mighty lightning bolts..', libtcod.white)
+	libtcod.console_print_ex(panel, 1, 0, libtcod.BKGND_NONE, libtcod.LEFT, names)
 
+	if profiling:
+		render_profile_overlay()
 
-mouse = libtcod.Mouse()
-key = libtcod.Key()
-
-libtcod.sys_set_fps(50)
-
-render_all()
-libtcod.console_flush()	
-
-counter = 0
-
-while not libtcod.console_is_window_closed():
-
-
-	libtcod.sys_check_for_event(libtcod.EVENT_KEY_PRESS|libtcod.EVENT_MOUSE,key,mouse)	
-
-	for object in objects:
-		object.clear()
+    #blit the contents of "panel" to the root console
+	if not headless:
+		libtcod.console_blit(panel, 0, 0, SCREEN_WIDTH, PANEL_HEIGHT, 0, 0, PANEL_Y)
+	profile_lap('render', start)
+	return True
+
+def wake_monsters(x, y, radius, alert=0):
+	#put the sleeping monsters within a radius of (x, y) on the schedule, to act from the current tick on.
+	#with an alert tick, all the monsters in the radius also stay awake until then, wherever the player is
+	(xs, ys, awake, alerts) = (entities.x, entities.y, entities.awake, entities.alert)
+	(bx1, by1) = ((x - radius) / NEIGHBOUR_BUCKET_SIZE, (y - radius) / NEIGHBOUR_BUCKET_SIZE)
+	(bx2, by2) = ((x + radius) / NEIGHBOUR_BUCKET_SIZE, (y + radius) / NEIGHBOUR_BUCKET_SIZE)
+	for bx in range(bx1, bx2 + 1):
+		for by in range(by1, by2 + 1):
+			for obj in fighter_buckets.get((bx, by), ()):
+				slot = obj.slot
+				if obj.ai and (xs[slot] - x) ** 2 + (ys[slot] - y) ** 2 <= radius ** 2:
+					alerts[slot] = max(alerts[slot], alert)
+					if not awake[slot]:
+						awake[slot] = 1
+						heapq.heappush(schedule, (current_tick, slot))
+
+def make_noise(x, y, radius):
+	#a noise wakes up the monsters that can hear it, for a while
+	wake_monsters(x, y, radius, current_tick + NOISE_ALERT_TICKS)
+
+def monster_turns():
+	#let the monsters act until the player's next turn, as a generator that stops after every monster's turn so
+	#the turns can be spread over several frames. the ones near the player are woken up first; then every
+	#awake monster acts whenever its time comes, as often as its speed allows, and the ones due at the same tick
+	#act in slot order. a monster that is too far from the player falls asleep instead of acting, unless it
+	#heard a noise not long ago
+	global current_tick
+	wake_monsters(player.x, player.y, ACTIVITY_RADIUS)
+
+	(xs, ys, speeds, awake, alerts) = (entities.x, entities.y, entities.speed, entities.awake, entities.alert)
+	end = current_tick + TURN_TICKS
+	while schedule and schedule[0][0] < end:
+		(current_tick, slot) = heapq.heappop(schedule)
+		monster = entities.objects[slot]
+		if not monster.ai or ((xs[slot] - player.x) ** 2 + (ys[slot] - player.y) ** 2 > ACTIVITY_RADIUS ** 2 and
+				alerts[slot] <= current_tick):
+			awake[slot] = 0  #dead, or asleep until woken up again
+			continue
+		monster.ai.take_turn()
+		heapq.heappush(schedule, (current_tick + TURN_TICKS * NORMAL_SPEED / speeds[slot], slot))
+		yield
+	current_tick = end
+
+	if DEBUG:
+		check_object_index()
+
+def monsters_take_turns():
+	#let the monsters act until the player's next turn, all at once
+	for turn in monster_turns():
+		pass
+
+def play_monster_turns(turns, budget):
+	#play the monster turns of a monster_turns generator for up to budget seconds (0 for no limit), and tell
+	#whether they are all played. nothing else changes the game in between, so a turn played over several
+	#frames ends up the same as one played at once
+	deadline = time.time() + budget
+	for turn in turns:
+		if budget and time.time() >= deadline:
+			return False
+	return True
+
+def new_game(seed=None, world=False):
+	#set up the state of a new game: the player, the first level (or the world) and the message log.
+	#nothing is drawn here. the level is made from the seed, or from a random one
+	global player, game_msgs, game_state, turn_counter, camera_x, camera_y, game_rng
+
+	if seed is None:
+		seed = random.randint(0, 0x7fffffff)
+	game_rng = random.Random(seed)
+
+	(hp, defense, power, mp) = PLAYER_STATS
+	fighter_component = Fighter(hp=hp, defense=defense, power=power, death_function=player_death)
+	mage_component = Mage(mp=mp)
+	player = Object(0, 0, '@', 'player', libtcod.white, blocks=True, fighter=fighter_component, mage=mage_component)
+
+	if world:
+		start_world(seed)
+	else:
+		load_level(get_level(seed))
+	(camera_x, camera_y) = (0, 0)
+	reset_render_cache()
+
+	game_msgs = MessageLog()
+	game_state = 'playing'
+	turn_counter = 0
+
+	message('Welcome stranger! Prepare to perish in the Tombs of the Ancient Kings.', libtcod.white)
+	message('Press Backspace or Del to hurl mighty lightning bolts..', libtcod.white)
+
+#the module globals that make up the state of one game. a process can run many games (see server.py) by
+#keeping each game's values in a GameSlot, and swapping them in around its turns. a new global of the game
+#state must be added here
+GAME_GLOBALS = ['map', 'fov_map', 'nav_map', 'nav_path', 'fov_recompute', 'fov_origin', 'fov_box', 'fov_bits',
+	'fov_cache', 'chase_field', 'chase_field_origin', 'entities', 'objects', 'corpses', 'object_index', 'corpse_index',
+	'fighter_buckets', 'player', 'game_msgs', 'game_state', 'turn_counter', 'player_action', 'schedule',
+	'current_tick', 'game_rng', 'level_seed', 'camera_x', 'camera_y', 'world_origin', 'window_chunks', 'chunk_cache',
+	'key', 'mouse', 'tile_cache', 'lit_box', 'drawn_glyphs', 'panel_state', 'room_graph']
+
+class GameSlot(object):
+	#the state of a game that is not the current one. a new slot has empty containers for the globals that
+	#are changed in place; new_game sets the others once the slot is active
+	__slots__ = ('state',)
 
-	player_action = handle_keys()
-	if player_action == 'exit':
-		break
+	def __init__(self):
+		self.state = {'entities': EntityStore(), 'schedule': [], 'fov_cache': collections.OrderedDict(),
+			'chunk_cache': collections.OrderedDict(), 'window_chunks': {}, 'world_origin': None,
+			'key': libtcod.Key(), 'mouse': libtcod.Mouse(), 'player_action': None}
+
+	def activate(self):
+		#make this game the current one
+		globals().update(self.state)
+
+	def deactivate(self):
+		#take back the state of this game, once it is not the current one anymore
+		current = globals()
+		self.state = dict((name, current[name]) for name in GAME_GLOBALS if name in current)
+
+def init_console():
+	#open the window and create the offscreen consoles that render_all draws to
+	global con, panel
+	libtcod.console_set_custom_font('arial10x10.png', libtcod.FONT_TYPE_GREYSCALE | libtcod.FONT_LAYOUT_TCOD)
+	libtcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT, 'python/libtcod tutorial', False)
+	make_consoles()
+	libtcod.sys_set_fps(LIMIT_FPS)
+
+def make_consoles():
+	global con, panel
+	con = libtcod.console_new(CAMERA_WIDTH, CAMERA_HEIGHT)
+	panel = libtcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
+
+def play_game(budget=AI_FRAME_BUDGET):
+	#the main loop of the windowed game. when the monsters take longer than the budget, their turn goes on
+	#over several frames and the player's next key waits for it
+	global key, mouse, player_action
+
+	mouse = libtcod.Mouse()
+	key = libtcod.Key()
+
+	libtcod.sys_set_fps(50)
 
-	for object in objects:
-		object.clear()
+	render_all()
+	libtcod.console_flush()	
 
-	if game_state == 'playing' and player_action != 'didnt-take-turn':
-		for object in objects:
-			if object.ai:
-				object.ai.take_turn()
+	turns = None  #the monster turns still to play, see monster_turns
+	while not libtcod.console_is_window_closed():
 
-	render_all()
-	libtcod.console_flush()					
+		took_turn = False
+		if turns is None:
+			#sleep until there is a key press, a mouse event or a window event, instead of polling every frame
+			if not wait_for_event():
+				break
 
+			start = profile_clock()
+			player_action = handle_keys()
+			if player_action == 'exit':
+				break
+			profile_lap('handle_keys', start)
+			if game_state == 'playing' and player_action != 'didnt-take-turn':
+				turns = monster_turns()
+		else:
+			#only follow the mouse: the keys and window events stay queued until the monsters are done
+			mouse = libtcod.mouse_get_status()
+
+		if turns is not None:
+			start = profile_clock()
+			if play_monster_turns(turns, budget):
+				turns = None
+				took_turn = True
+				if recorder is not None and turn_counter % REPLAY_CHECKPOINT_TURNS == 0:
+					record_checkpoint()
+			profile_lap('ai', start)
+
+		#only show a new frame if something was drawn: the mouse moved over nothing, a key did nothing...
+		if render_all(turns is not None):
+			start = profile_clock()
+			libtcod.console_flush()					
+			profile_lap('flush', start)
+		if turns is None:
+			#the phases of a turn played over several frames add up
+			profile_end_frame(took_turn)
+
+def terminal_color(color):
+	#the closest color of the xterm 256 color palette: in the color cube, or one of the 24 grays
+	rgb = (color.r, color.g, color.b)
+	cube = [min(range(6), key=lambda i: abs(TERMINAL_CUBE_LEVELS[i] - c)) for c in rgb]
+	cube_error = sum((TERMINAL_CUBE_LEVELS[i] - c) ** 2 for (i, c) in zip(cube, rgb))
+	gray = max(0, min(23, (sum(rgb) / 3 - 8 + 5) / 10))
+	gray_error = sum((8 + 10 * gray - c) ** 2 for c in rgb)
+	if gray_error < cube_error:
+		return 232 + gray
+	return 16 + 36 * cube[0] + 6 * cube[1] + cube[2]
+
+class TerminalScreen(object):
+	#draws consoles to an ANSI terminal. the cells the terminal shows are kept in a shadow framebuffer, so a
+	#frame only writes the cells that changed since the last one: the cursor is moved to each run of changed
+	#cells, and a color code is only written when the colors change
+	__slots__ = ('width', 'height', 'cells', 'shown', 'colors')
+
+	def __init__(self, width, height):
+		self.width = width
+		self.height = height
+		self.cells = [(ord(' '), 16, 16)] * (width * height)  #(char, foreground, background) of every cell
+		self.colors = {}  #terminal colors by (r, g, b)
+		self.reset()
+
+	def reset(self):
+		#forget what the terminal shows, so the next frame draws everything
+		self.shown = [None] * (self.width * self.height)
+
+	def color(self, color):
+		index = self.colors.get((color.r, color.g, color.b))
+		if index is None:
+			index = self.colors[(color.r, color.g, color.b)] = terminal_color(color)
+		return index
+
+	def draw(self, console, x0, y0, width, height):
+		#copy a console to the frame, with its top left corner at (x0, y0)
+		self.draw_cells(console, x0, y0, itertools.product(range(width), range(height)))
+
+	def draw_cells(self, console, x0, y0, positions):
+		#copy only some cells (x, y) of a console to the frame, the ones that may have changed since the last frame
+		(get_char, get_foreground, get_background) = (libtcod.console_get_char,
+			libtcod.console_get_char_foreground, libtcod.console_get_char_background)
+		(cells, color, width) = (self.cells, self.color, self.width)
+		for (x, y) in positions:
+			cells[(y0 + y) * width + x0 + x] = (get_char(console, x, y), color(get_foreground(console, x, y)),
+				color(get_background(console, x, y)))
+
+	def frame(self):
+		#the bytes to write to the terminal to show the frame
+		out = []
+		(cells, shown, width) = (self.cells, self.shown, self.width)
+		(cursor_x, cursor_y, foreground, background) = (None, None, None, None)
+		for y in range(self.height):
+			row = y * width
+			if cells[row:row + width] == shown[row:row + width]:
+				continue
+			for x in range(width):
+				cell = cells[row + x]
+				if cell == shown[row + x]:
+					continue
+				(char, cell_foreground, cell_background) = cell
+				if y != cursor_y or x != cursor_x:
+					gap = None
+					if y == cursor_y and cursor_x is not None and cursor_x < x <= cursor_x + 3:
+						gap = cells[row + cursor_x:row + x]
+					if gap and all(f == foreground and b == background for (c, f, b) in gap):
+						#rewriting a few unchanged cells is shorter than moving the cursor over them
+						out.extend(chr(c) if 32 <= c < 127 else '?' for (c, f, b) in gap)
+					else:
+						out.append('\x1b[%d;%dH' % (y + 1, x + 1))
+				if cell_foreground != foreground and cell_background != background:
+					out.append('\x1b[38;5;%d;48;5;%dm' % (cell_foreground, cell_background))
+				elif cell_foreground != foreground:
+					out.append('\x1b[38;5;%dm' % cell_foreground)
+				elif cell_background != background:
+					out.append('\x1b[48;5;%dm' % cell_background)
+				(foreground, background) = (cell_foreground, cell_background)
+				out.append(chr(char) if 32 <= char < 127 else '?')
+				(cursor_x, cursor_y) = (x + 1, y)
+				if cursor_x == width:
+					cursor_x = None  #where the cursor is after the last column depends on the terminal
+			shown[row:row + width] = cells[row:row + width]
+		return ''.join(out)
+
+def render_terminal(screen, mid_turn=False):
+	#render_all, and the bytes that show what it drew on a TerminalScreen ('' if nothing changed). only the
+	#cells that render_all touched are read from the consoles: the tiles whose state changed, the glyphs that
+	#were drawn or erased, and the panel if it was drawn again
+	(old_tiles, old_glyphs, old_panel) = (tile_cache[:], drawn_glyphs, panel_state)
+	if not render_all(mid_turn):
+		return ''
+	positions = set(old_glyphs)
+	positions.update(drawn_glyphs)
+	for x in range(CAMERA_WIDTH):
+		i = x * CAMERA_HEIGHT
+		if tile_cache[i:i + CAMERA_HEIGHT] != old_tiles[i:i + CAMERA_HEIGHT]:
+			positions.update((x, y) for y in range(CAMERA_HEIGHT) if tile_cache[i + y] != old_tiles[i + y])
+	screen.draw_cells(con, 0, 0, positions)
+	if panel_state != old_panel:
+		screen.draw(panel, 0, PANEL_Y, SCREEN_WIDTH, PANEL_HEIGHT)
+	return screen.frame()
+
+def write_terminal(fd, data):
+	#write all the bytes to a terminal. os.write can write only a part of them, when the terminal is slow to read
+	while data:
+		data = data[os.write(fd, data):]
+
+def read_terminal_key(fd):
+	#wait for a key in a terminal, and return its libtcod key (KEY_NONE if unknown, None at the end of the input)
+	data = os.read(fd, 1)
+	if not data:
+		return None
+	if data == '\x1b' and select.select([fd], [], [], TERMINAL_ESCAPE_DELAY)[0]:
+		#an escape sequence: ESC [ or ESC O, then parameters up to a final byte between @ and ~
+		data += os.read(fd, 1)
+		if data[1] in '[O':
+			while True:
+				byte = os.read(fd, 1)
+				data += byte
+				if not byte or '@' <= byte <= '~':
+					break
+	return TERMINAL_KEYS.get(data, libtcod.KEY_NONE)
+
+def play_terminal(budget=AI_FRAME_BUDGET):
+	#the main loop of the game played in a terminal (over SSH...) instead of a window: keys are read from
+	#stdin, and frames drawn to stdout by a TerminalScreen. like in headless mode there is no mouse, and
+	#lightning bolts aim at the closest monster. like in the window, the monsters play within the budget
+	#of every frame, and the keys typed meanwhile wait in the terminal
+	global key, mouse, headless, player_action
+	import termios, tty  #only on Unix
+	headless = True
+	key = libtcod.Key()
+	mouse = libtcod.Mouse()
+
+	screen = TerminalScreen(SCREEN_WIDTH, SCREEN_HEIGHT)
+	(fd_in, fd_out) = (sys.stdin.fileno(), sys.stdout.fileno())
+	settings = termios.tcgetattr(fd_in)
+	tty.setcbreak(fd_in)
+	try:
+		write_terminal(fd_out, TERMINAL_START + render_terminal(screen))
+		turns = None  #the monster turns still to play, see monster_turns
+		while True:
+			took_turn = False
+			if turns is None:
+				key.vk = read_terminal_key(fd_in)
+				if key.vk is None:
+					break
+				start = profile_clock()
+				player_action = handle_keys()
+				if player_action == 'exit':
+					break
+				profile_lap('handle_keys', start)
+				if game_state == 'playing' and player_action != 'didnt-take-turn':
+					turns = monster_turns()
+
+			if turns is not None:
+				start = profile_clock()
+				if play_monster_turns(turns, budget):
+					turns = None
+					took_turn = True
+				profile_lap('ai', start)
+			frame = render_terminal(screen, turns is not None)
+			if frame:
+				start = profile_clock()
+				write_terminal(fd_out, frame)
+				profile_lap('flush', start)
+			if turns is None:
+				profile_end_frame(took_turn)
+	finally:
+		write_terminal(fd_out, TERMINAL_END)
+		termios.tcsetattr(fd_in, termios.TCSADRAIN, settings)
+
+def wait_for_event():
+	#sleep until there is a key press, a mouse event or a window event, and tell whether the game goes on
+	#(false if the window was closed). the events that can change the game are recorded. when replaying,
+	#the next recorded event is taken instead
+	if replay is not None:
+		return next_replay_event()
+	libtcod.sys_wait_for_event(libtcod.EVENT_KEY_PRESS|libtcod.EVENT_MOUSE,key,mouse,False)
+	if libtcod.console_is_window_closed():
+		return False
+	if recorder is not None and (key.vk != libtcod.KEY_NONE or mouse.lbutton_pressed or mouse.rbutton_pressed):
+		#the mouse position is recorded on the map, the camera is not moved when replaying
+		record([key.vk, bool(key.lalt), camera_x + mouse.cx, camera_y + mouse.cy,
+			bool(mouse.lbutton_pressed), bool(mouse.rbutton_pressed)])
+	return True
+
+def state_hash():
+	#a hash of all the state that the game logic reads and changes, to check that a replay ends up the same.
+	#the schedule is hashed sorted: the layout of the heap is not part of the state
+	h = hashlib.sha1()
+	h.update(map.blocked)
+	h.update(map.block_sight)
+	for field in EntityStore.FIELDS:
+		h.update(ints_to_bytes(getattr(entities, field)))
+	h.update(repr([(obj.slot, obj.name, obj.char, obj.blocks) for obj in itertools.chain(corpses, objects)]))
+	h.update(repr((game_state, turn_counter, [entry[:5] for entry in game_msgs.entries], current_tick, sorted(schedule),
+		world_origin, game_rng.getstate())))
+	return h.hexdigest()
+
+def record(entry):
+	recorder.write(json.dumps(entry) + '\n')
+
+def record_checkpoint(end=False):
+	record({'turn': turn_counter, 'hash': state_hash(), 'end': end})
+
+def start_recording(path):
+	#record the game that was just started to a file, for run_replay
+	global recorder
+	recorder = open(path, 'w')
+	record({'format': REPLAY_FORMAT, 'seed': level_seed, 'world': world_origin is not None})
+
+def stop_recording():
+	global recorder
+	record_checkpoint(end=True)
+	recorder.close()
+	recorder = None
+
+def check_replay(checkpoint):
+	#remember the first checkpoint where the state differs from the recording
+	global replay_mismatch
+	if replay_mismatch is None and checkpoint['hash'] != state_hash():
+		replay_mismatch = checkpoint['turn']
+
+def next_replay_event():
+	#put the next recorded event in key and mouse, checking the checkpoints on the way. false at the end
+	global replay_end
+	for line in replay:
+		entry = json.loads(line)
+		if isinstance(entry, dict):
+			if entry['end']:
+				replay_end = entry  #checked by run_replay once the game really ended
+				return False
+			check_replay(entry)
+			continue
+		(key.vk, key.lalt, x, y, mouse.lbutton_pressed, mouse.rbutton_pressed) = entry
+		(mouse.cx, mouse.cy) = (x - camera_x, y - camera_y)
+		return True
+	return False
+
+def run_replay(path):
+	#play a recorded game again with no window and no frame cap, and return the number of turns played and
+	#the turn of the first checkpoint where the state differs from the recording (None if none does)
+	global key, mouse, headless, replay, replay_mismatch, replay_end, player_action
+	with open(path) as f:
+		header = json.loads(f.readline())
+		if header.get('format') != REPLAY_FORMAT:
+			raise ValueError('%s is not a recording of this version of the game' % path)
+		new_game(header['seed'], header['world'])
+		headless = True
+		(key, mouse) = (libtcod.Key(), libtcod.Mouse())
+		replay = f
+		replay_mismatch = None
+		replay_end = None
+		played = 0
+		update_fov()
+		try:
+			while wait_for_event():
+				start = profile_clock()
+				player_action = handle_keys()
+				if player_action == 'exit':
+					break
+				start = profile_lap('handle_keys', start)
+				took_turn = game_state == 'playing' and player_action != 'didnt-take-turn'
+				if took_turn:
+					monsters_take_turns()
+					start = profile_lap('ai', start)
+					played += 1
+				#FOV is updated at the same point of the turn as render_all does in the windowed game
+				update_fov()
+				profile_lap('fov', start)
+				profile_end_frame(took_turn)
+			while next_replay_event():
+				pass  #the game was left, nothing but the last checkpoint should be left to read
+		finally:
+			replay = None
+	if replay_end is None:
+		raise ValueError('%s ends before the end of the game, it was not recorded to the end' % path)
+	check_replay(replay_end)
+	return (played, replay_mismatch)
+
+def run_headless(turns, inputs=None, seed=None):
+	#play up to the given number of turns of the current game with no window and no frame cap.
+	#inputs is a sequence of HEADLESS_KEYS names; without it, keys are picked at random from the seed.
+	#stops early if the inputs run out or the player dies, and returns the number of turns played
+	global key, headless, player_action
+	headless = True
+	if inputs is None:
+		rng = random.Random(seed)
+		names = sorted(HEADLESS_KEYS)
+		inputs = (rng.choice(names) for i in itertools.count())
+
+	key = libtcod.Key()
+	played = 0
+	update_fov()
+	for name in inputs:
+		if played >= turns or game_state != 'playing':
+			break
+		key.vk = HEADLESS_KEYS[name]
+		start = profile_clock()
+		player_action = handle_keys()
+		start = profile_lap('handle_keys', start)
+		if player_action != 'didnt-take-turn':
+			monsters_take_turns()
+			start = profile_lap('ai', start)
+		#FOV is updated at the same point of the turn as render_all would in the windowed game
+		update_fov()
+		profile_lap('fov', start)
+		profile_end_frame(True)
+		played += 1
+	return played
+
+def check_budgeted_turns(seed, turns, world=False):
+	#play the same game twice from random keys: once with the monster turns played at once, and once with
+	#one monster per frame and a frame drawn in between, like in the window with a tiny budget. returns the
+	#number of turns played and the first turn after which the game states differ (None if none does)
+	global key, mouse, headless, player_action
+	headless = True
+	(key, mouse) = (libtcod.Key(), libtcod.Mouse())
+	names = sorted(HEADLESS_KEYS)
+	hashes = []
+	for sliced in (False, True):
+		new_game(seed, world)
+		rng = random.Random(seed)
+		render_all()
+		hashes.append([])
+		while len(hashes[-1]) < turns and game_state == 'playing':
+			key.vk = HEADLESS_KEYS[rng.choice(names)]
+			player_action = handle_keys()
+			if player_action != 'didnt-take-turn':
+				for turn in monster_turns():
+					if sliced:
+						render_all(True)
+			render_all()
+			hashes[-1].append(state_hash())
+	(whole, sliced) = hashes
+	for (turn, (a, b)) in enumerate(itertools.izip_longest(whole, sliced)):
+		if a != b:
+			return (len(whole), turn + 1)
+	return (len(whole), None)
+
+def start_game(args):
+	#a new game, or the one in the snapshot given on the command line
+	if args.load:
+		load_game(args.load)
+	else:
+		new_game(args.seed, args.world)
+
+def main():
+	parser = argparse.ArgumentParser(description='A roguelike game based on libtcod.')
+	parser.add_argument('--headless', action='store_true', help='run the game logic only, with no window or font')
+	parser.add_argument('--terminal', action='store_true', help='play in the terminal, with no window or font')
+	parser.add_argument('--turns', type=int, default=1000, help='number of turns to play in headless mode')
+	parser.add_argument('--seed', type=int, help='seed for the level, and for the random keys of headless mode')
+	parser.add_argument('--world', action='store_true', help='play in an endless world instead of a level')
+	parser.add_argument('--load', metavar='FILE', help='resume the game saved in a snapshot, instead of a new game')
+	parser.add_argument('--save', metavar='FILE', help='save a snapshot of the game when it ends')
+	parser.add_argument('--record', metavar='FILE', help='record the events of the game, to replay it with --replay')
+	parser.add_argument('--replay', metavar='FILE',
+		help='play a recorded game again with no window, as fast as possible, and check that it ends the same')
+	parser.add_argument('--combat-log', metavar='FILE', help='write every attack, lightning bolt and death to a file')
+	parser.add_argument('--check-budget', type=int, metavar='SEEDS',
+		help='check on that many seeds (from --seed on) that monster turns spread over frames end up the same')
+	parser.add_argument('--profile', action='store_true',
+		help='start with profiling on (F3 toggles it), writing every turn to ' + PROFILE_TRACE_FILE)
+	parser.add_argument('--ai-budget', type=float, default=AI_FRAME_BUDGET * 1000, metavar='MS',
+		help='milliseconds per frame the monsters can play in, in the window and the terminal (0: no limit)')
+	parser.add_argument('--input', help='file with one key per line (' + ', '.join(sorted(HEADLESS_KEYS)) +
+		') to play in headless mode, instead of random keys')
+	args = parser.parse_args()
+	if args.record and (args.headless or args.terminal or args.load):
+		parser.error('--record records a new game played in the window')
+
+	if args.profile:
+		toggle_profiling()
+	if args.combat_log:
+		start_combat_log(args.combat_log)
+
+	if args.check_budget:
+		make_consoles()
+		mismatches = 0
+		for seed in range(args.seed or 0, (args.seed or 0) + args.check_budget):
+			(played, mismatch) = check_budgeted_turns(seed, args.turns, args.world)
+			print('seed %d: %d turns, %s' % (seed, played, 'the same' if mismatch is None else
+				'differs from turn %d on' % mismatch))
+			mismatches += mismatch is not None
+		if mismatches:
+			sys.exit(1)
+		return
+
+	if args.replay:
+		start = time.time()
+		(played, mismatch) = run_replay(args.replay)
+		elapsed = max(time.time() - start, 1e-9)
+		print('%d turns replayed in %.3f s (%.0f turns/s), game state: %s' % (played, elapsed, played / elapsed, game_state))
+		if args.combat_log:
+			stop_combat_log()
+		if mismatch is not None:
+			print('the game differs from the recording from turn %d on' % mismatch)
+			sys.exit(1)
+		return
+
+	if args.terminal:
+		make_consoles()
+		start_game(args)
+		play_terminal(args.ai_budget / 1000)
+		if args.save:
+			save_game(args.save)
+		if args.combat_log:
+			stop_combat_log()
+		return
+
+	if not args.headless:
+		init_console()
+		start_game(args)
+		if args.record:
+			start_recording(args.record)
+		play_game(args.ai_budget / 1000)
+		if args.record:
+			stop_recording()
+		if args.save:
+			save_game(args.save)
+		if args.combat_log:
+			stop_combat_log()
+		return
+
+	inputs = None
+	if args.input:
+		inputs = []
+		with open(args.input) as f:
+			for (number, line) in enumerate(f, 1):
+				name = line.strip()
+				if not name:
+					continue
+				if name not in HEADLESS_KEYS:
+					parser.error('%s, line %d: unknown key %r (the keys are %s)' % (args.input, number, name,
+						', '.join(sorted(HEADLESS_KEYS))))
+				inputs.append(name)
+
+	start_game(args)
+	start = time.time()
+	played = run_headless(args.turns, inputs, args.seed)
+	elapsed = max(time.time() - start, 1e-9)
+	print('%d turns in %.3f s (%.0f turns/s), game state: %s' % (played, elapsed, played / elapsed, game_state))
+	if args.save:
+		save_game(args.save)
+	if args.combat_log:
+		stop_combat_log()
+
+if __name__ == '__main__':
+	try:
+		main()
+	finally:
+		stop_level_pool()
+		close_profile_trace()
@@ -0,0 +1,249 @@
+#a game server: one process plays the games of many clients, each in its own rogue.GameSlot, and after every
+#turn sends only what changed. clients connect to localhost TCP or a Unix socket and exchange JSON lines:
+#	{"new": {"seed": 42}}  starts a game (random seed if none), answered with the whole first view
+#	{"key": "up"}          plays a turn with one of rogue.HEADLESS_KEYS, answered with what changed
+#a view is the size of the map and its walls (first view only), the tiles that came into FOV ("lit") and went
+#out of it ("dark") as [x, y], the objects in FOV that appeared, moved or changed as [id, char, x, y] and the
+#ids of the ones that are not seen anymore ("gone"), and the turn, plus the messages, hp, mp and game state
+#when they changed. there is no mouse, so lightning bolts aim at the closest monster, like in headless mode.
+#	python server.py --port 7777
+#	python server.py --bench --clients 100 --turns 200
+#--bench runs the server in another process and plays random keys from many simulated clients, to measure
+#the turns per second of one server process and the latency of the turns
+import argparse
+import asynchat
+import asyncore
+import json
+import multiprocessing
+import os
+import random
+import select
+import socket
+import time
+
+import rogue
+
+DEFAULT_PORT = 7777
+
+#the simulated clients of --bench restart their game when it ends, with one of this many seeds (so the
+#levels come from the cache after the first games)
+BENCH_SEEDS = 8
+
+
+class ServerGame(object):
+	#one game of the server, with what its client was last sent
+	def __init__(self, seed):
+		self.slot = rogue.GameSlot()
+		self.slot.activate()
+		try:
+			rogue.new_game(seed)
+			self.visible = set()  #the tiles in FOV, as x * height + y
+			self.shown = {}  #the objects in FOV, by slot: (char, x, y)
+			self.sent = {}  #the messages, stats and game state last sent
+			view = self.view(rogue.update_fov())
+			view['map'] = {'width': rogue.map.width, 'height': rogue.map.height, 'walls': [''.join(
+				'#' if rogue.map.block_sight[x * rogue.map.height + y] else '.' for x in range(rogue.map.width))
+				for y in range(rogue.map.height)]}
+			self.first_view = view
+		finally:
+			self.slot.deactivate()
+
+	def turn(self, name):
+		#play a turn from a key, and return what changed
+		self.slot.activate()
+		try:
+			rogue.key.vk = rogue.HEADLESS_KEYS[name]
+			rogue.player_action = rogue.handle_keys()
+			if rogue.game_state == 'playing' and rogue.player_action != 'didnt-take-turn':
+				rogue.monsters_take_turns()
+			return self.view(rogue.update_fov())
+		finally:
+			self.slot.deactivate()
+
+	def view(self, fov_changed):
+		#what changed since the last view, on the current game
+		view = {'turn': rogue.turn_counter}
+		height = rogue.map.height
+		visible = self.visible
+		if fov_changed:
+			(x1, y1, x2, y2) = rogue.fov_box
+			visible = set(x * height + y for x in range(x1, x2) for y in range(y1, y2) if rogue.in_fov(x, y))
+			view['lit'] = [divmod(i, height) for i in visible - self.visible]
+			view['dark'] = [divmod(i, height) for i in self.visible - visible]
+			self.visible = visible
+
+		shown = {}
+		for obj in rogue.corpses:
+			if obj.x * height + obj.y in visible:
+				shown[obj.slot] = (obj.char, obj.x, obj.y)
+		for obj in rogue.objects:
+			if obj == rogue.player or obj.x * height + obj.y in visible:
+				shown[obj.slot] = (obj.char, obj.x, obj.y)
+		changed = [[slot] + list(obj) for (slot, obj) in shown.items() if self.shown.get(slot) != obj]
+		if changed:
+			view['objects'] = changed
+		gone = [slot for slot in self.shown if slot not in shown]
+		if gone:
+			view['gone'] = gone
+		self.shown = shown
+
+		player = rogue.player
+		for (name, value) in (('messages', rogue.game_msgs.version), ('hp', (player.fighter.hp, player.fighter.max_hp)),
+				('mp', (player.mage.mp, player.mage.max_mp)), ('state', rogue.game_state)):
+			if self.sent.get(name) != value:
+				self.sent[name] = value
+				if name == 'messages':
+					value = [line for (line, color) in rogue.game_msgs.lines()]
+				view[name] = value
+		return view
+
+
+class GameChannel(asynchat.async_chat):
+	#the connection of one client, and its game
+	def __init__(self, sock, game_map):
+		asynchat.async_chat.__init__(self, sock, map=game_map)
+		self.set_terminator('\n')
+		self.received = []
+		self.game = None
+
+	def collect_incoming_data(self, data):
+		self.received.append(data)
+
+	def found_terminator(self):
+		line = ''.join(self.received)
+		self.received = []
+		try:
+			request = json.loads(line)
+		except ValueError:
+			request = None
+		self.push(json.dumps(self.answer(request), separators=(',', ':')) + '\n')
+
+	def answer(self, request):
+		if not isinstance(request, dict):
+			return {'error': 'not a JSON object'}
+		if 'new' in request:
+			self.game = ServerGame((request['new'] or {}).get('seed'))
+			return self.game.first_view
+		if 'key' in request:
+			if self.game is None:
+				return {'error': 'no game, start one with "new"'}
+			if request['key'] not in rogue.HEADLESS_KEYS:
+				return {'error': 'unknown key: %r' % request['key']}
+			return self.game.turn(request['key'])
+		return {'error': 'unknown request'}
+
+class GameServer(asyncore.dispatcher):
+	#accepts the clients, on localhost TCP or a Unix socket
+	def __init__(self, address, game_map):
+		asyncore.dispatcher.__init__(self, map=game_map)
+		self.game_map = game_map
+		if isinstance(address, str):
+			if os.path.exists(address):
+				os.remove(address)
+			self.create_socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		else:
+			self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+			self.set_reuse_addr()
+		self.bind(address)
+		self.listen(128)
+
+	def handle_accept(self):
+		pair = self.accept()
+		if pair is not None:
+			GameChannel(pair[0], self.game_map)
+
+def serve(address):
+	#run a server until the process is stopped
+	rogue.headless = True
+	game_map = {}
+	GameServer(address, game_map)
+	asyncore.loop(map=game_map)
+
+
+def percentile(values, fraction):
+	values = sorted(values)
+	return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def bench(address, clients, turns, seed):
+	#play turns of random keys from many clients at once, all sending a key then waiting for all the answers.
+	#returns the number of turns played, the seconds it took, the latencies of the turns and the bytes received
+	rng = random.Random(seed)
+	sockets = []
+	for i in range(clients):
+		sock = socket.socket(socket.AF_UNIX if isinstance(address, str) else socket.AF_INET, socket.SOCK_STREAM)
+		for attempt in range(100):
+			try:
+				sock.connect(address)
+				break
+			except socket.error:
+				time.sleep(0.05)  #the server is still starting
+		sockets.append(sock)
+	names = sorted(rogue.HEADLESS_KEYS)
+
+	def exchange(requests):
+		#send a request from every client, and return the answers with their latencies
+		sent = {}
+		for (sock, request) in zip(sockets, requests):
+			sent[sock] = time.time()
+			sock.sendall(json.dumps(request) + '\n')
+		received = dict((sock, '') for sock in sockets)
+		answers = {}
+		while len(answers) < len(sockets):
+			for sock in select.select([sock for sock in sockets if sock not in answers], [], [])[0]:
+				data = sock.recv(65536)
+				if not data:
+					raise IOError('the server closed the connection')
+				received[sock] += data
+				if received[sock].endswith('\n'):
+					answers[sock] = (json.loads(received[sock]), time.time() - sent[sock], len(received[sock]))
+		return [answers[sock] for sock in sockets]
+
+	#a client whose game ended starts a new one instead of its next turn
+	new_game = lambda: {'new': {'seed': rng.randrange(BENCH_SEEDS)}}
+	exchange([new_game() for sock in sockets])
+	ended = [False] * clients
+	latencies = []
+	size = 0
+	start = time.time()
+	for turn in range(turns):
+		answers = exchange([new_game() if end else {'key': rng.choice(names)} for end in ended])
+		for (i, (view, latency, length)) in enumerate(answers):
+			latencies.append(latency)
+			size += length
+			if 'state' in view:
+				ended[i] = view['state'] != 'playing'
+	elapsed = time.time() - start
+	for sock in sockets:
+		sock.close()
+	return (len(latencies), elapsed, latencies, size)
+
+def main():
+	parser = argparse.ArgumentParser(description='Serve many games from one process')
+	parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='TCP port on localhost')
+	parser.add_argument('--unix', metavar='PATH', help='listen on a Unix socket instead')
+	parser.add_argument('--bench', action='store_true', help='measure a server with simulated clients')
+	parser.add_argument('--clients', type=int, default=100, help='number of simulated clients')
+	parser.add_argument('--turns', type=int, default=100, help='number of turns each simulated client plays')
+	parser.add_argument('--seed', type=int, default=0, help='seed of the keys of the simulated clients')
+	args = parser.parse_args()
+	address = args.unix or ('127.0.0.1', args.port)
+
+	if not args.bench:
+		serve(address)
+		return
+
+	server = multiprocessing.Process(target=serve, args=(address,))
+	server.daemon = True
+	server.start()
+	try:
+		(played, elapsed, latencies, size) = bench(address, args.clients, args.turns, args.seed)
+	finally:
+		server.terminate()
+	print('%d clients, %d turns in %.2f s: %.0f turns/s on one server process' % (args.clients, played, elapsed,
+		played / elapsed))
+	print('latency of a turn: p50 %.1f ms, p90 %.1f ms, p99 %.1f ms, %.0f bytes per turn' % (
+		1000 * percentile(latencies, 0.5), 1000 * percentile(latencies, 0.9), 1000 * percentile(latencies, 0.99),
+		float(size) / played))
+
+if __name__ == '__main__':
+	main()